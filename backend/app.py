@@ -1,28 +1,45 @@
 # === IMPORTS ===
 import eventlet
 eventlet.monkey_patch()
+from eventlet import tpool
 
-from flask import Flask, request, jsonify, session, send_from_directory
+from flask import Flask, request, jsonify, session, send_file
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_migrate import Migrate
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from sqlalchemy.exc import OperationalError
+from werkzeug.exceptions import RequestEntityTooLarge
 import boto3
 from botocore.client import Config
 from io import BytesIO
+from PIL import Image, ImageOps, UnidentifiedImageError
 import redis
 import time
 import uuid
 import os
 import json
 import tempfile
+import gzip
+import hashlib
+import hmac
+import mimetypes
 import requests
-import traceback
+import logging
 import click
+import msgspec
+from collections import OrderedDict
+from codec import DEFAULT_ROOM, ChatMessage, ConnectedUser, SocketIOJSON, codec
+from hashing import HashQueueFull, hash_password, hash_stats, verify_password
+from metrics import InstrumentedRedis, metrics
 
 # === CONFIGURATION FLASK & REDIS ===
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+logger = logging.getLogger('tchat')
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'change-moi-vite')
 app.config['SESSION_TYPE'] = 'filesystem'
@@ -34,10 +51,17 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
     'POSTGRESQL_ADDON_URI',
     'sqlite:///local.db'
 )
-app.config['CELLAR_ADDON_HOST'] = "cellar-c2.services.clever-cloud.com"
-app.config['CELLAR_ADDON_KEY_ID'] = "3MZQFZBSK7EV0CPOJNKN"
-app.config['CELLAR_ADDON_KEY_SECRET'] = "ycvC9eQzC6tufUSonj3JHTVQAPvjsDnjz0tTBkbJ"
-app.config['CELLAR_BUCKET'] = 'mybucket-tchat'
+app.config['CELLAR_ADDON_HOST'] = os.environ.get('CELLAR_ADDON_HOST', "cellar-c2.services.clever-cloud.com")
+app.config['CELLAR_ADDON_KEY_ID'] = os.environ.get('CELLAR_ADDON_KEY_ID', "3MZQFZBSK7EV0CPOJNKN")
+app.config['CELLAR_ADDON_KEY_SECRET'] = os.environ.get('CELLAR_ADDON_KEY_SECRET', "ycvC9eQzC6tufUSonj3JHTVQAPvjsDnjz0tTBkbJ")
+app.config['CELLAR_BUCKET'] = os.environ.get('CELLAR_BUCKET', 'mybucket-tchat')
+# A local S3 stand-in (MinIO, moto...) is used by pointing the endpoint and the
+# public URL at it, e.g. http://localhost:9000 and http://localhost:9000/<bucket>.
+app.config['CELLAR_ENDPOINT'] = os.environ.get('CELLAR_ENDPOINT', f"https://{app.config['CELLAR_ADDON_HOST']}")
+app.config['CELLAR_PUBLIC_URL'] = os.environ.get(
+    'CELLAR_PUBLIC_URL',
+    f"https://{app.config['CELLAR_BUCKET']}.{app.config['CELLAR_ADDON_HOST']}"
+)
 
 
 port = int(os.environ.get('PORT', 5000))
@@ -51,7 +75,10 @@ CORS(app, origins=[
 ], supports_credentials=True)
 
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
-r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+r = InstrumentedRedis.from_url(REDIS_URL, decode_responses=True)
+# Encoded payloads (connected users, message records, archive queue) are read
+# as raw bytes so the codec can use msgpack as well as JSON.
+rb = InstrumentedRedis.from_url(REDIS_URL)
 
 socketio = SocketIO(app, cors_allowed_origins=[
     "http://localhost:5173",
@@ -60,11 +87,38 @@ socketio = SocketIO(app, cors_allowed_origins=[
     "http://localhost:9000",
     "https://tchat-visio.cleverapps.io",
     "https://tchat-visio.cleverapps.io/socket.io/"
-], async_mode="eventlet", manage_session=True, message_queue=REDIS_URL, path='/socket.io/')
+], async_mode="eventlet", manage_session=True, message_queue=REDIS_URL, path='/socket.io/', json=SocketIOJSON)
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+# === INSTRUMENTATION ===
+# Socket.IO handlers are timed by on_event(); Socket.IO traffic does not go
+# through these hooks.
+@app.before_request
+def start_request_timer():
+    metrics.begin(f"route:{request.endpoint}")
+
+@app.after_request
+def count_server_errors(response):
+    if response.status_code >= 500:
+        metrics.count_error(f"route:{request.endpoint}")
+    return response
+
+@app.teardown_request
+def stop_request_timer(exc):
+    metrics.end()
+
+def on_event(event):
+    """socketio.on() recording the handler's latency and Redis calls."""
+    def decorator(handler):
+        return socketio.on(event)(metrics.timed('socketio', event)(handler))
+    return decorator
+
+def local_audience(room=None):
+    """Sockets of this worker reached by an emit to `room` (all of them for None)."""
+    return len(socketio.server.manager.rooms.get('/', {}).get(room, ()))
+
 # === TABLE USER ===
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -72,22 +126,143 @@ class User(db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     avatar_url = db.Column(db.String(256), nullable=True)
 
+# === TABLES ARCHIVE DES MESSAGES ===
+class Message(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    seq = db.Column(db.BigInteger, unique=True, nullable=False)
+    author = db.Column(db.String(80), nullable=False, index=True)
+    recipient = db.Column(db.String(80), nullable=True, index=True)
+    room = db.Column(db.String(80), nullable=True, index=True)
+    text = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.Float, nullable=False, index=True)
+
+class MessageReaction(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.String(36), db.ForeignKey('message.id'), nullable=False, index=True)
+    emoji = db.Column(db.String(64), nullable=False)
+    username = db.Column(db.String(80), nullable=False)
+    reacted_at = db.Column(db.Float, nullable=False)
+    __table_args__ = (db.UniqueConstraint('message_id', 'emoji', 'username'),)
 
 with app.app_context():
     db.create_all()
 
+# === CACHE DES PROFILS UTILISATEURS ===
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', 2048))
+PROFILE_CACHE_TTL = int(os.environ.get('PROFILE_CACHE_TTL', 60))
+PROFILE_BATCH_SIZE = 500
+
+class ProfileCache:
+    """LRU/TTL cache of user profiles keyed by username.
+
+    Misses are loaded with one ``IN (...)`` query per batch. Unknown usernames
+    (anonymous sockets) are cached as ``None`` so they do not hit the database
+    on every presence update either. Each worker has its own cache: writes go
+    through invalidate_profile(), which tells the other workers over Redis.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, username):
+        return self.get_many([username]).get(username)
+
+    def get_many(self, usernames):
+        now = time.time()
+        found = {}
+        missing = []
+        for username in set(usernames):
+            entry = self._entries.get(username)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(username)
+                found[username] = entry[1]
+                self.hits += 1
+            else:
+                missing.append(username)
+                self.misses += 1
+        for start in range(0, len(missing), PROFILE_BATCH_SIZE):
+            batch = missing[start:start + PROFILE_BATCH_SIZE]
+            rows = User.query.with_entities(User.username, User.avatar_url) \
+                .filter(User.username.in_(batch)).all()
+            loaded = {row.username: {'username': row.username, 'avatar_url': row.avatar_url} for row in rows}
+            for username in batch:
+                profile = loaded.get(username)
+                self._store(username, profile, now)
+                found[username] = profile
+        return found
+
+    def invalidate(self, username):
+        self._entries.pop(username, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def _store(self, username, profile, now):
+        self._entries[username] = (now, profile)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+PROFILE_INVALIDATION_CHANNEL = "profile_invalidations"
+
+def invalidate_profile(username):
+    """Drops `username` from the profile cache of every worker."""
+    profile_cache.invalidate(username)
+    r.publish(PROFILE_INVALIDATION_CHANNEL, username)
+
+def profile_invalidation_listener():
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(PROFILE_INVALIDATION_CHANNEL)
+            # Invalidations published while we were not subscribed are lost
+            profile_cache.clear()
+            for message in pubsub.listen():
+                profile_cache.invalidate(message['data'])
+        except redis.RedisError:
+            logger.exception("Échec de l'écoute des invalidations de profils")
+            socketio.sleep(1)
+
 # === AUTHENTIFICATION ===
+# Accounts allowed to clear a room and delete other users' messages
+ADMIN_USERS = {name.strip() for name in os.environ.get('ADMIN_USERS', '').split(',') if name.strip()}
+
+def is_admin(username):
+    return username in ADMIN_USERS
+
+@app.errorhandler(HashQueueFull)
+def hash_queue_full(e):
+    return jsonify({'error': 'Serveur surchargé, réessayez dans un instant.'}), 503
+
 @app.route('/register', methods=['POST'])
 def register():
     data = request.json
     username = data.get('username')
     password = data.get('password')
-    if User.query.filter_by(username=username).first():
+    # A name held by an anonymous socket would share its private messages
+    if User.query.filter_by(username=username).first() or r.exists(user_sids_key(username)):
         return jsonify({'error': 'Nom d’utilisateur déjà pris.'}), 409
-    password_hash = generate_password_hash(password)
+    password_hash = hash_password(password)
     new_user = User(username=username, password_hash=password_hash)
     db.session.add(new_user)
     db.session.commit()
+    invalidate_profile(username)
     session['username'] = username
     return jsonify({'message': 'Inscription réussie !'}), 200
 
@@ -97,7 +272,7 @@ def login():
     username = data.get('username')
     password = data.get('password')
     user = User.query.filter_by(username=username).first()
-    if not user or not check_password_hash(user.password_hash, password):
+    if not user or not verify_password(user.password_hash, password):
         return jsonify({'error': 'Nom d’utilisateur ou mot de passe invalide.'}), 401
     session['username'] = username
     return jsonify({'message': 'Connexion réussie !'}), 200
@@ -105,11 +280,16 @@ def login():
 @app.route('/me', methods=['GET'])
 def me():
     if 'username' in session:
-        user = User.query.filter_by(username=session['username']).first()
-        if user:
+        profile = profile_cache.get(session['username'])
+        if not profile:
+            # The cached miss may predate an account created on another worker
+            profile_cache.invalidate(session['username'])
+            profile = profile_cache.get(session['username'])
+        if profile:
             return jsonify({
                 'username': session['username'],
-                'avatar_url': user.avatar_url
+                'avatar_url': profile['avatar_url'],
+                'is_admin': is_admin(session['username'])
             })
         else:
             # This case might happen if the user was deleted but the session still exists
@@ -124,50 +304,228 @@ def logout():
     return jsonify({'message': 'Déconnexion réussie !'})
 
 # === FRONTEND REACT SERVE ===
+# The dist directory is scanned once at startup: restart the server after a
+# new frontend build. Vite gives every file under assets/ a content-hashed
+# name, so those can be cached forever; everything else is revalidated with
+# its ETag. Precompressed .br/.gz siblings (see `flask compress-assets`) are
+# served to clients that accept them.
+FRONTEND_DIST_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'frontend', 'dist')
+HASHED_ASSETS_PREFIX = 'assets/'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+COMPRESSED_SUFFIXES = OrderedDict([('br', '.br'), ('gzip', '.gz')])  # By preference
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+def build_static_manifest(root):
+    manifest = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith(tuple(COMPRESSED_SUFFIXES.values())):
+                continue
+            full_path = os.path.join(dirpath, name)
+            path = os.path.relpath(full_path, root).replace(os.sep, '/')
+            manifest[path] = {
+                'file': full_path,
+                'mimetype': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                'etag': file_digest(full_path),
+                'cache_control': IMMUTABLE_CACHE_CONTROL if path.startswith(HASHED_ASSETS_PREFIX) else REVALIDATE_CACHE_CONTROL,
+                # A variant older than its source is left over from a previous build
+                'variants': OrderedDict(
+                    (encoding, full_path + suffix)
+                    for encoding, suffix in COMPRESSED_SUFFIXES.items()
+                    if os.path.exists(full_path + suffix)
+                    and os.path.getmtime(full_path + suffix) >= os.path.getmtime(full_path)
+                ),
+                'bodies': None,
+            }
+    index = manifest.get('index.html')
+    if index:
+        # Served for every client-side route: kept in memory, gzipped if no
+        # precompressed version was shipped.
+        with open(index['file'], 'rb') as f:
+            bodies = {None: f.read()}
+        for encoding, variant in index['variants'].items():
+            with open(variant, 'rb') as f:
+                bodies[encoding] = f.read()
+        if 'gzip' not in bodies:
+            bodies['gzip'] = gzip.compress(bodies[None], compresslevel=9, mtime=0)
+            index['variants']['gzip'] = None
+        index['bodies'] = bodies
+    return manifest
+
+static_manifest = build_static_manifest(FRONTEND_DIST_DIR)
+
+def pick_encoding(entry):
+    for encoding in entry['variants']:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+def static_response(entry):
+    encoding = pick_encoding(entry)
+    if entry['bodies'] is not None:
+        response = app.response_class(entry['bodies'][encoding], mimetype=entry['mimetype'])
+    else:
+        response = send_file(
+            entry['variants'][encoding] if encoding else entry['file'],
+            mimetype=entry['mimetype'],
+            etag=False,
+            conditional=False,
+        )
+    response.set_etag(f"{entry['etag']}-{encoding}" if encoding else entry['etag'])
+    response.headers['Cache-Control'] = entry['cache_control']
+    if entry['variants']:
+        response.vary.add('Accept-Encoding')
+    if encoding:
+        response.content_encoding = encoding
+    return response.make_conditional(request)
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve_react(path):
-    root_dir = os.path.abspath(os.path.dirname(__file__))
-    frontend_dist_dir = os.path.join(root_dir, 'frontend', 'dist')
-
-    print(f"Requested path: {path}")
-    full_path = os.path.join(frontend_dist_dir, path)
-    print(f"Full path to check: {full_path}")
-    print(f"Does path exist: {os.path.exists(full_path)}")
-
-    # If the path is for a static file, serve it
-    if path and os.path.exists(full_path):
-        print(f"Serving static file: {path}")
-        return send_from_directory(frontend_dist_dir, path)
-    # Otherwise, serve the index.html for client-side routing
-    print("Serving index.html for client-side routing")
-    return send_from_directory(frontend_dist_dir, 'index.html')
+    entry = static_manifest.get(path)
+    if entry is None:
+        if path.startswith(HASHED_ASSETS_PREFIX):
+            return jsonify({'error': 'Fichier introuvable'}), 404
+        # Otherwise, serve the index.html for client-side routing
+        entry = static_manifest.get('index.html')
+        if entry is None:
+            return jsonify({'error': 'Frontend non construit'}), 404
+    return static_response(entry)
+
+@app.cli.command('compress-assets')
+def compress_assets():
+    """Écrit les variantes .gz (et .br si le module brotli est installé) du frontend."""
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    count = 0
+    for entry in build_static_manifest(FRONTEND_DIST_DIR).values():
+        if not entry['mimetype'].startswith(COMPRESSIBLE_TYPES):
+            continue
+        with open(entry['file'], 'rb') as f:
+            data = f.read()
+        with open(entry['file'] + COMPRESSED_SUFFIXES['gzip'], 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli:
+            with open(entry['file'] + COMPRESSED_SUFFIXES['br'], 'wb') as f:
+                f.write(brotli.compress(data))
+        count += 1
+    click.echo(f"{count} fichier(s) compressé(s).")
 
 # === VISITEURS ACTIFS ===
-visitors = {}
+# Shared by every worker: a sorted set of session ids scored by last ping.
+VISITORS_KEY = "active_visitors"
+VISITOR_WINDOW = 2
+VISITOR_COUNT_TTL = 1
+VISITOR_TRIM_INTERVAL = 5
+visitor_count_cache = {'value': 0, 'expires': 0.0}
+
+def count_active_visitors():
+    now = time.time()
+    if now >= visitor_count_cache['expires']:
+        visitor_count_cache['value'] = r.zcount(VISITORS_KEY, now - VISITOR_WINDOW, '+inf')
+        visitor_count_cache['expires'] = now + VISITOR_COUNT_TTL
+    return visitor_count_cache['value']
+
+def visitors_janitor():
+    while True:
+        try:
+            r.zremrangebyscore(VISITORS_KEY, '-inf', time.time() - VISITOR_WINDOW)
+        except redis.RedisError:
+            logger.exception("Échec du nettoyage des visiteurs")
+        socketio.sleep(VISITOR_TRIM_INTERVAL)
 
 @app.route('/ping', methods=['POST'])
 def ping():
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
-    sid = session['session_id']
-    visitors[sid] = time.time()
+    r.zadd(VISITORS_KEY, {session['session_id']: time.time()})
     return jsonify({'status': 'pong'})
 
 @app.route('/active_visitors')
 def active_visitors():
-    now = time.time()
-    active = [sid for sid, last_ping in visitors.items() if now - last_ping < 2]
-    return jsonify({'active_visitors': len(active)})
+    return jsonify({'active_visitors': count_active_visitors()})
 
 @app.route('/user/<username>')
 def get_user_info(username):
-    user = User.query.filter_by(username=username).first()
-    if user:
-        return jsonify({'username': user.username, 'avatar_url': user.avatar_url or '/default-avatar.jpg'})
+    profile = profile_cache.get(username)
+    if profile:
+        return jsonify({'username': profile['username'], 'avatar_url': profile['avatar_url'] or '/default-avatar.jpg'})
     return jsonify({'error': 'User not found'}), 404
 
+# Scrapers authenticate with "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+@app.route('/metrics')
+def get_metrics():
+    """Counters of the worker answering the request, for admins only."""
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not is_admin(session.get('username')) and not (METRICS_TOKEN and hmac.compare_digest(token, METRICS_TOKEN)):
+        return jsonify({'error': 'Accès refusé.'}), 403
+    return jsonify({
+        'worker': WORKER_ID,
+        **metrics.snapshot(),
+        'profile_cache': profile_cache.stats(),
+        'password_hashing': hash_stats,
+        'presence_pending': len(pending_presence),
+    })
+
 # === UPLOAD AVATAR AVEC BOTO3 ===
+AVATAR_MAX_BYTES = int(os.environ.get('AVATAR_MAX_BYTES', 5 * 1024 * 1024))
+AVATAR_SIZE = int(os.environ.get('AVATAR_SIZE', 128))
+# A few KB of PNG can declare a huge canvas: the size is checked from the
+# header, before anything is decoded.
+AVATAR_MAX_PIXELS = int(os.environ.get('AVATAR_MAX_PIXELS', 4096 * 4096))
+AVATAR_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP', 'BMP'}
+S3_POOL_SIZE = 10
+
+# One S3 client (thread-safe, only used to presign) and one pooled HTTP session
+# for the PUTs, shared by every upload.
+s3 = boto3.client(
+    's3',
+    endpoint_url=app.config['CELLAR_ENDPOINT'],
+    aws_access_key_id=app.config['CELLAR_ADDON_KEY_ID'],
+    aws_secret_access_key=app.config['CELLAR_ADDON_KEY_SECRET'],
+    config=Config(
+        signature_version='s3v4',
+        s3={'addressing_style': os.environ.get('CELLAR_ADDRESSING_STYLE', 'auto')},
+        max_pool_connections=S3_POOL_SIZE,
+    )
+)
+s3_http = requests.Session()
+s3_http.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=S3_POOL_SIZE))
+s3_http.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=S3_POOL_SIZE))
+
+def make_avatar_thumbnail(stream):
+    """Decodes an uploaded image and returns a small square WebP version.
+    Raises ValueError if the stream is not a supported image."""
+    try:
+        with Image.open(stream) as image:
+            if image.format not in AVATAR_FORMATS:
+                raise ValueError(image.format)
+            width, height = image.size
+            if width * height > AVATAR_MAX_PIXELS:
+                raise ValueError(f"{width}x{height}")
+            # JPEG can be decoded directly at a reduced scale
+            image.draft('RGB', (AVATAR_SIZE * 2, AVATAR_SIZE * 2))
+            # Shrink before any copy (rotation, RGBA) while keeping the short
+            # side large enough for the square crop
+            scale = AVATAR_SIZE * 2 / min(image.size)
+            if scale < 1:
+                image.thumbnail((max(1, round(image.width * scale)), max(1, round(image.height * scale))))
+            image = ImageOps.exif_transpose(image)
+            image = ImageOps.fit(image.convert('RGBA'), (AVATAR_SIZE, AVATAR_SIZE), Image.LANCZOS)
+            output = BytesIO()
+            image.save(output, 'WEBP', quality=80, method=4)
+            return output.getvalue()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise ValueError(str(e))
 
 @app.route("/upload-avatar", methods=["POST"])
 def upload_avatar():
@@ -175,236 +533,963 @@ def upload_avatar():
         if 'username' not in session:
             return jsonify({"error": "Non connecté"}), 401
 
+        # Werkzeug stops reading the body past this limit and answers 413;
+        # the file itself is spooled to disk, never read whole into memory.
+        request.max_content_length = AVATAR_MAX_BYTES
         file = request.files.get("file")
         if not file:
             return jsonify({"error": "No file"}), 400
 
         username = session['username']
-        ext = os.path.splitext(secure_filename(file.filename))[1]
-        filename = f"{username}_{uuid.uuid4().hex}{ext}"
-        bucket = "mybucket-tchat"
-        host = "cellar-c2.services.clever-cloud.com"
-
-        file_bytes = file.read()
-        if not file_bytes or len(file_bytes) == 0:
-            return jsonify({"error": "Fichier vide"}), 400
-
-        s3 = boto3.client(
-            's3',
-            endpoint_url=f"https://{host}",
-            aws_access_key_id="3MZQFZBSK7EV0CPOJNKN",
-            aws_secret_access_key="ycvC9eQzC6tufUSonj3JHTVQAPvjsDnjz0tTBkbJ",
-            config=Config(signature_version='s3v4')
-        )
+        filename = f"{username}_{uuid.uuid4().hex}.webp"
+        key = f"avatars/{filename}"
+
+        try:
+            thumbnail = tpool.execute(make_avatar_thumbnail, file.stream)
+        except ValueError:
+            return jsonify({"error": "Image invalide"}), 400
 
         # Génère une URL PUT pré-signée
         presigned_url = s3.generate_presigned_url(
             'put_object',
             Params={
-                'Bucket': bucket,
-                'Key': f"avatars/{filename}",
+                'Bucket': app.config['CELLAR_BUCKET'],
+                'Key': key,
                 'ACL': 'public-read',
-                'ContentType': file.content_type
+                'ContentType': 'image/webp',
+                'CacheControl': 'public, max-age=31536000, immutable',
             },
             ExpiresIn=60
         )
 
         # Upload direct via HTTP PUT avec Content-Length
-        resp = requests.put(
+        resp = s3_http.put(
             presigned_url,
-            data=file_bytes,
+            data=thumbnail,
             headers={
-                'Content-Type': file.content_type,
+                'Content-Type': 'image/webp',
+                'Cache-Control': 'public, max-age=31536000, immutable',
                 'x-amz-acl': 'public-read',
-                'Content-Length': str(len(file_bytes))
-            }
+                'Content-Length': str(len(thumbnail))
+            },
+            timeout=30
         )
 
         if resp.status_code not in (200, 201):
             return jsonify({"error": f"Upload failed: {resp.status_code} {resp.text}"}), 500
 
-        public_url = f"https://{bucket}.{host}/avatars/{filename}"
+        public_url = f"{app.config['CELLAR_PUBLIC_URL']}/{key}"
 
         user = User.query.filter_by(username=username).first()
         if user:
             user.avatar_url = public_url
             db.session.commit()
+            invalidate_profile(username)
 
         return jsonify({"url": public_url})
+    except RequestEntityTooLarge:
+        return jsonify({"error": "Fichier trop volumineux"}), 413
     except Exception as e:
-        import traceback
-        print(traceback.format_exc())
+        logger.exception("Échec de l'upload de l'avatar")
         return jsonify({"error": str(e)}), 500
 # === CHAT GLOBAL SYNCHRONISÉ AVEC REDIS ===
 
-MAX_MESSAGES = 500
-TYPING_USERS_KEY = "typing_users"
+MAX_MESSAGES = int(os.environ.get('MAX_MESSAGES', 500))
+MAX_PRIVATE_MESSAGES = int(os.environ.get('MAX_PRIVATE_MESSAGES', 200))
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 100
+TYPING_USERS_KEY_PREFIX = "typing_users:"
+TYPING_SNAPSHOT_KEY_PREFIX = "typing_users_snapshot:"
+TYPING_TTL = 3
+TYPING_TICK = 0.5
+WORKER_ID = uuid.uuid4().hex
+PRESENCE_HEARTBEAT_INTERVAL = 10
+PRESENCE_WORKER_TTL = 30
+# Column sizes of the archive: longer values would fail the archive insert
+USERNAME_MAX_LENGTH = 80
+EMOJI_MAX_LENGTH = 64
+
+def valid_field(value, max_length):
+    return isinstance(value, str) and 0 < len(value) <= max_length
+
+def parse_rooms(spec):
+    """Parses CHAT_ROOMS ("name" or "name:cap", comma separated) into an
+    ordered {room: cap} map that always starts with the default room."""
+    rooms = OrderedDict([(DEFAULT_ROOM, MAX_MESSAGES)])
+    for entry in spec.split(','):
+        name, _, cap = entry.strip().partition(':')
+        if name:
+            rooms[name] = int(cap) if cap else MAX_MESSAGES
+    return rooms
+
+CHAT_ROOMS = parse_rooms(os.environ.get('CHAT_ROOMS', 'general,jeux,musique'))
+
+def decode_connected_user(sid, user_data):
+    """Returns the record, or None (logged) if it cannot be decoded."""
+    try:
+        return codec.decode(user_data, ConnectedUser)
+    except (msgspec.ValidationError, msgspec.DecodeError):
+        logger.warning("Enregistrement de présence illisible ignoré (SID : %s)", sid)
+        return None
+
+def get_connected_user(sid):
+    user_data = rb.hget('connected_users', sid)
+    return decode_connected_user(sid, user_data) if user_data else None
 
 def get_connected_users():
-    users = r.hvals('connected_users')
     result = []
-    for u in users:
-        user_info = json.loads(u)
-        db_user = User.query.filter_by(username=user_info["username"]).first()
-        avatar_url = db_user.avatar_url if db_user else None
-        user_info["avatar_url"] = avatar_url
-        result.append(user_info)
+    for sid, user_data in rb.hgetall('connected_users').items():
+        user_info = decode_connected_user(sid, user_data)
+        if user_info is not None:
+            result.append(user_info)
+    profiles = profile_cache.get_many(user_info.username for user_info in result)
+    for user_info in result:
+        profile = profiles.get(user_info.username)
+        user_info.avatar_url = profile["avatar_url"] if profile else None
     return result
 
+def user_sids_key(username):
+    return f"user_sids:{username}"
+
+def worker_key(worker_id):
+    return f"worker_alive:{worker_id}"
+
+def get_user_sids(username):
+    return r.smembers(user_sids_key(username))
+
+# Events for a given sid are handled one at a time by the worker owning the
+# socket, so reading the old record before the MULTI block cannot race with
+# another update of the same sid.
+# user_sids:<username> is the set private messages are delivered to. Logged in
+# sockets are listed under their account, anonymous ones under the name the
+# server gave them or one they picked that was neither registered nor online.
 def add_connected_user(sid, username):
-    user_info = {"username": username, "connected_at": time.time(), "sid": sid}
-    r.hset('connected_users', sid, json.dumps(user_info))
+    user_info = ConnectedUser(username=username, connected_at=time.time(), sid=sid, worker=WORKER_ID)
+    pipe = r.pipeline()
+    pipe.hset('connected_users', sid, codec.encode(user_info))
+    pipe.sadd(user_sids_key(username), sid)
+    pipe.execute()
+    return user_info
+
+def set_user_room(user_info, room):
+    user_info.room = room
+    rb.hset('connected_users', user_info.sid, codec.encode(user_info))
 
 def remove_connected_user(sid):
-    r.hdel('connected_users', sid)
+    user_info = get_connected_user(sid)
+    pipe = r.pipeline()
+    pipe.hdel('connected_users', sid)
+    if user_info:
+        pipe.srem(user_sids_key(user_info.username), sid)
+    pipe.execute()
+    return user_info
+
+# The name is only taken if no socket holds it, checked in the same step so
+# two sockets cannot claim it at once.
+rename_script = r.register_script("""
+if redis.call('SCARD', KEYS[3]) > 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('SREM', KEYS[2], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[1])
+return 1
+""")
 
 def update_username(sid, new_username):
-    user_json = r.hget('connected_users', sid)
-    if user_json:
-        user_info = json.loads(user_json)
-        user_info["username"] = new_username
-        user_info["connected_at"] = time.time()
-        r.hset('connected_users', sid, json.dumps(user_info))
+    """Returns the updated record, or None if the sid is unknown, unchanged,
+    or the name is used by another socket."""
+    user_info = get_connected_user(sid)
+    if user_info:
+        old_username = user_info.username
+        if old_username == new_username:
+            return None
+        user_info.username = new_username
+        user_info.connected_at = time.time()
+        renamed = rename_script(
+            keys=['connected_users', user_sids_key(old_username), user_sids_key(new_username)],
+            args=[sid, codec.encode(user_info)],
+        )
+        return user_info if renamed else None
+
+def prune_stale_sids():
+    """Drop sids owned by workers whose heartbeat has expired, and records
+    that cannot be decoded."""
+    entries = []
+    unreadable = []
+    for sid, user_data in rb.hgetall('connected_users').items():
+        user_info = decode_connected_user(sid, user_data)
+        if user_info is None:
+            unreadable.append(sid)
+        else:
+            entries.append(user_info)
+    if unreadable:
+        rb.hdel('connected_users', *unreadable)
+    workers = list({u.worker for u in entries if u.worker})
+    alive = set()
+    if workers:
+        flags = r.mget([worker_key(w) for w in workers])
+        alive = {w for w, flag in zip(workers, flags) if flag}
+    stale = [u.sid for u in entries if u.worker not in alive]
+    for sid in stale:
+        user_info = remove_connected_user(sid)
+        if user_info:
+            queue_presence_change(sid, 'user_left', user_info)
+    return stale
+
+def presence_heartbeat():
+    while True:
+        try:
+            r.set(worker_key(WORKER_ID), 1, ex=PRESENCE_WORKER_TTL)
+            stale = prune_stale_sids()
+            if stale:
+                logger.info("%d SID(s) orphelin(s) supprimé(s).", len(stale))
+        except redis.RedisError:
+            logger.exception("Échec du heartbeat de présence")
+        socketio.sleep(PRESENCE_HEARTBEAT_INTERVAL)
+
+# Presence changes are buffered per worker and flushed as one delta per tick.
+# Changes to the same sid are merged, so a socket that joins and leaves within
+# the window is never announced at all.
+PRESENCE_VERSION_KEY = "presence_version"
+PRESENCE_FLUSH_INTERVAL = 0.25
+pending_presence = OrderedDict()
+
+def queue_presence_change(sid, change, user_info):
+    previous = pending_presence.get(sid)
+    if previous and previous[0] == 'user_joined':
+        if change == 'user_left':
+            del pending_presence[sid]
+            return
+        change = 'user_joined'  # Renamed before anyone saw it join
+    pending_presence[sid] = (change, user_info)
+
+def presence_snapshot():
+    # Same ordering argument as messages_snapshot(): deltas are idempotent.
+    version = int(r.get(PRESENCE_VERSION_KEY) or 0)
+    return {'version': version, 'users': get_connected_users()}
+
+def flush_presence():
+    if not pending_presence:
+        return
+    changes = list(pending_presence.items())
+    pending_presence.clear()
+    profiles = profile_cache.get_many(
+        info.username for _, (change, info) in changes if change != 'user_left'
+    )
+    events = []
+    for sid, (change, info) in changes:
+        if change == 'user_left':
+            events.append({'type': change, 'sid': sid, 'username': info.username})
+        else:
+            profile = profiles.get(info.username)
+            user = msgspec.structs.replace(info, avatar_url=profile['avatar_url'] if profile else None)
+            events.append({'type': change, 'user': user})
+    version = r.incr(PRESENCE_VERSION_KEY)
+    if len(events) == 1:
+        event = events[0]
+        socketio.emit(event.pop('type'), {**event, 'version': version})
+    else:
+        socketio.emit('presence_batch', {'version': version, 'events': events})
+    metrics.fanout('presence', local_audience())
+
+def presence_flusher():
+    while True:
+        socketio.sleep(PRESENCE_FLUSH_INTERVAL)
+        try:
+            with app.app_context():
+                flush_presence()
+        except Exception:
+            logger.exception("Échec de l'envoi des changements de présence")
+
+# Messages are stored one record per key, ordered by a sorted-set index
+# scored with a global sequence number. Reactions live in a hash per message
+# whose fields are JSON [emoji, username] pairs valued with the reaction time,
+# so toggling a reaction or deleting a message never rewrites the history.
+# Each change is also appended to ARCHIVE_QUEUE_KEY in the same atomic step,
+# for archive_writer() to replay into SQL. Every room and every private
+# conversation has its own index and cap. A conversation is either a room name
+# or the sorted pair of usernames of a private conversation; the default room
+# keeps the original index key.
+MESSAGE_INDEX_KEY = "message_index"
+ROOM_INDEX_KEY_PREFIX = "room_index:"
+PRIVATE_INDEX_KEY_PREFIX = "dm_index:"
+MESSAGE_SEQ_KEY = "message_seq"
+MESSAGE_KEY_PREFIX = "message:"
+REACTIONS_KEY_PREFIX = "reactions:"
+ARCHIVE_QUEUE_KEY = "archive_queue"
+ARCHIVE_DEAD_LETTER_KEY = "archive_dead_letter"
+
+def conversation_key(username, other):
+    return tuple(sorted((username, other)))
 
-def get_messages():
-    return [json.loads(m) for m in r.lrange('messages', -MAX_MESSAGES, -1)]
+def conversation_of(message):
+    if message.recipient:
+        return conversation_key(message.pseudo, message.recipient)
+    return message.room
+
+def is_private(conversation):
+    return isinstance(conversation, tuple)
+
+def index_key(conversation=DEFAULT_ROOM):
+    if is_private(conversation):
+        return PRIVATE_INDEX_KEY_PREFIX + json.dumps(list(conversation))
+    if conversation == DEFAULT_ROOM:
+        return MESSAGE_INDEX_KEY
+    return ROOM_INDEX_KEY_PREFIX + conversation
+
+def message_key(message_id):
+    return f"{MESSAGE_KEY_PREFIX}{message_id}"
+
+def reactions_key(message_id):
+    return f"{REACTIONS_KEY_PREFIX}{message_id}"
+
+# The sequence number is reserved before the script runs so the archive entry
+# can be encoded in Python: Lua only ever moves opaque codec payloads.
+# For a room, KEYS[3] is its event sequence, taken in the same script so the
+# new_message events of a room go out in the order the messages were stored.
+add_message_script = r.register_script("""
+redis.call('SET', ARGV[4] .. ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[6], ARGV[1])
+redis.call('RPUSH', KEYS[2], ARGV[7])
+local overflow = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[3])
+if overflow > 0 then
+    for _, id in ipairs(redis.call('ZRANGE', KEYS[1], 0, overflow - 1)) do
+        redis.call('DEL', ARGV[4] .. id, ARGV[5] .. id)
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, overflow - 1)
+end
+if KEYS[3] then
+    return redis.call('INCR', KEYS[3])
+end
+return 0
+""")
+
+# Returns -1 if the message is gone, else {event seq (0 without KEYS[4]),
+# reactions hash after the toggle}: the users list and the seq sent with it
+# always describe the same state.
+toggle_reaction_script = r.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+if redis.call('HDEL', KEYS[2], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[3], ARGV[4])
+else
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('RPUSH', KEYS[3], ARGV[3])
+end
+local seq = 0
+if KEYS[4] then
+    seq = redis.call('INCR', KEYS[4])
+end
+return {seq, redis.call('HGETALL', KEYS[2])}
+""")
+
+# Reaction fields are hash keys rather than payloads: they keep the stdlib
+# JSON form so a toggle always matches the field it created.
+def reaction_field(emoji, username):
+    return json.dumps([emoji, username])
+
+def decode_reactions(raw):
+    reactions = {}
+    for field, _ in sorted(raw.items(), key=lambda item: float(item[1])):
+        emoji, username = msgspec.json.decode(field)
+        reactions.setdefault(emoji, []).append(username)
+    return reactions
+
+def load_messages(message_ids):
+    if not message_ids:
+        return []
+    pipe = rb.pipeline(transaction=False)
+    pipe.mget([message_key(message_id) for message_id in message_ids])
+    for message_id in message_ids:
+        pipe.hgetall(reactions_key(message_id))
+    records, *reactions = pipe.execute()
+    messages = []
+    for record, raw in zip(records, reactions):
+        if record is None:  # Deleted between the index read and the fetch
+            continue
+        message = codec.decode(record, ChatMessage)
+        message.reactions = decode_reactions(raw)
+        messages.append(message)
+    return messages
+
+# Never creates the counter: after a Redis flush every caller gets nil until
+# one of them has re-seeded it above the archive, so no seq is handed out
+# from scratch and collides with an archived one.
+incr_existing_script = r.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+return redis.call('INCR', KEYS[1])
+""")
+
+def next_message_seq():
+    seq = incr_existing_script(keys=[MESSAGE_SEQ_KEY])
+    while seq is None:
+        max_seq = db.session.query(db.func.max(Message.seq)).scalar() or 0
+        r.set(MESSAGE_SEQ_KEY, max_seq, nx=True)  # The first worker to get here wins
+        seq = incr_existing_script(keys=[MESSAGE_SEQ_KEY])
+    return seq
 
 def add_message(message, recipient=None):
-    r.rpush('messages', json.dumps(message))
-    r.ltrim('messages', -MAX_MESSAGES, -1)
+    """Stores the message; returns the room's new event seq (None for a private message)."""
+    record = msgspec.structs.replace(message, reactions={})
+    conversation = conversation_key(message.pseudo, recipient) if recipient else message.room
+    keys = [index_key(conversation), ARCHIVE_QUEUE_KEY]
+    if not recipient:
+        keys.append(event_seq_key(message.room))
+    seq = next_message_seq()
+    event_seq = add_message_script(
+        keys=keys,
+        args=[
+            message.id,
+            codec.encode(record),
+            MAX_PRIVATE_MESSAGES if recipient else CHAT_ROOMS.get(message.room, MAX_MESSAGES),
+            MESSAGE_KEY_PREFIX,
+            REACTIONS_KEY_PREFIX,
+            seq,
+            codec.encode(["add", seq, record]),
+        ],
+    )
+    return None if recipient else event_seq
+
+def locate_message(message_id):
+    """Returns (conversation, author) for a message in Redis or in the archive,
+    or (None, None) if it does not exist."""
+    record = rb.get(message_key(message_id))
+    if record:
+        message = codec.decode(record, ChatMessage)
+        return conversation_of(message), message.pseudo
+    row = db.session.get(Message, message_id)
+    if row:
+        return conversation_key(row.author, row.recipient) if row.recipient else row.room or DEFAULT_ROOM, row.author
+    return None, None
+
+def toggle_reaction(message_id, emoji, username, conversation=None):
+    """Returns (users who reacted with `emoji`, event seq of the room or None),
+    or None if the message is no longer in Redis."""
+    reacted_at = time.time()
+    keys = [message_key(message_id), reactions_key(message_id), ARCHIVE_QUEUE_KEY]
+    if conversation is not None and not is_private(conversation):
+        keys.append(event_seq_key(conversation))
+    result = toggle_reaction_script(
+        keys=keys,
+        args=[
+            reaction_field(emoji, username),
+            reacted_at,
+            codec.encode(["react", message_id, emoji, username, reacted_at]),
+            codec.encode(["react", message_id, emoji, username, None]),
+        ],
+    )
+    if result == -1:
+        return None
+    seq, raw = result
+    users = decode_reactions(dict(zip(raw[::2], raw[1::2]))).get(emoji, [])
+    return users, seq or None
+
+def delete_message(message_id, conversation=DEFAULT_ROOM):
+    pipe = r.pipeline()
+    pipe.zrem(index_key(conversation), message_id)
+    pipe.delete(message_key(message_id), reactions_key(message_id))
+    pipe.rpush(ARCHIVE_QUEUE_KEY, codec.encode(["delete", message_id]))
+    return pipe.execute()[0] > 0
+
+def clear_messages(room=DEFAULT_ROOM):
+    """Clears one room; other rooms and private conversations are left untouched."""
+    message_ids = r.zrange(index_key(room), 0, -1)
+    pipe = r.pipeline()
+    pipe.delete(index_key(room))
+    for start in range(0, len(message_ids), 500):
+        batch = message_ids[start:start + 500]
+        pipe.delete(*[message_key(i) for i in batch], *[reactions_key(i) for i in batch])
+    pipe.rpush(ARCHIVE_QUEUE_KEY, codec.encode(["clear", room]))
+    pipe.execute()
+
+# === ARCHIVE SQL (WRITE-BEHIND) ===
+ARCHIVE_BATCH_SIZE = 200
+ARCHIVE_FLUSH_INTERVAL = 1
+ARCHIVE_LOCK_KEY = "archive_lock"
+
+def archived_message(row, reactions):
+    return ChatMessage(
+        id=row.id,
+        pseudo=row.author,
+        text=row.text,
+        timestamp=row.timestamp,
+        recipient=row.recipient,
+        room=row.room or DEFAULT_ROOM,
+        reactions=reactions.get(row.id, {}),
+    )
+
+def room_filter(room):
+    # Rows archived before rooms existed have no room and belong to the default one
+    if room == DEFAULT_ROOM:
+        return db.and_(Message.recipient.is_(None), db.or_(Message.room == room, Message.room.is_(None)))
+    return db.and_(Message.recipient.is_(None), Message.room == room)
+
+def get_archived_page(below_seq, limit, conversation=DEFAULT_ROOM):
+    if not is_private(conversation):
+        query = Message.query.filter(room_filter(conversation))
+    else:
+        a, b = conversation
+        query = Message.query.filter(db.or_(
+            db.and_(Message.author == a, Message.recipient == b),
+            db.and_(Message.author == b, Message.recipient == a),
+        ))
+    if below_seq is not None:
+        query = query.filter(Message.seq < below_seq)
+    rows = query.order_by(Message.seq.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit][::-1]
+    reactions = {}
+    if rows:
+        reaction_rows = MessageReaction.query \
+            .filter(MessageReaction.message_id.in_([row.id for row in rows])) \
+            .order_by(MessageReaction.reacted_at).all()
+        for reaction in reaction_rows:
+            reactions.setdefault(reaction.message_id, {}).setdefault(reaction.emoji, []).append(reaction.username)
+    return [archived_message(row, reactions) for row in rows], has_more
+
+def get_message_page(before_id=None, limit=HISTORY_PAGE_SIZE, conversation=DEFAULT_ROOM):
+    """Returns up to `limit` messages older than `before_id` (the latest ones
+    when it is None), oldest first, and whether older messages remain.
+    `conversation` is a room name or a private conversation.
+
+    The Redis window is read first and the SQL archive continues below it.
+    """
+    index = index_key(conversation)
+    cursor = None
+    if before_id is not None:
+        cursor = r.zscore(index, before_id)
+        if cursor is None:
+            cursor = Message.query.with_entities(Message.seq).filter_by(id=before_id).scalar()
+        if cursor is None:
+            return [], False
+    max_score = '+inf' if cursor is None else f"({int(cursor)}"
+    entries = r.zrevrangebyscore(index, max_score, '-inf', start=0, num=limit + 1, withscores=True)
+    messages = load_messages([message_id for message_id, _ in entries[:limit]][::-1])
+    if len(entries) > limit:
+        return messages, True
+    if entries:
+        cursor = entries[-1][1]
+    older, has_more = get_archived_page(cursor, limit - len(messages), conversation)
+    return older + messages, has_more
+
+def get_archived_reaction_users(message_id, emoji):
+    rows = MessageReaction.query.filter_by(message_id=message_id, emoji=emoji) \
+        .order_by(MessageReaction.reacted_at).all()
+    return [row.username for row in rows]
+
+def toggle_archived_reaction(message_id, emoji, username):
+    """Reaction on a message that only survives in the archive.
+    Returns the updated users list, or None if the message does not exist."""
+    if db.session.get(Message, message_id) is None:
+        return None
+    reaction = MessageReaction.query.filter_by(message_id=message_id, emoji=emoji, username=username).first()
+    if reaction:
+        db.session.delete(reaction)
+    else:
+        db.session.add(MessageReaction(message_id=message_id, emoji=emoji, username=username, reacted_at=time.time()))
+    db.session.commit()
+    return get_archived_reaction_users(message_id, emoji)
+
+def apply_archive_ops(ops):
+    """Replays queued changes in order. Safe to run twice on the same batch."""
+    pending = {}
+
+    def insert_pending():
+        if not pending:
+            return
+        existing = {row.id for row in Message.query.with_entities(Message.id).filter(Message.id.in_(list(pending)))}
+        rows = [row for message_id, row in pending.items() if message_id not in existing]
+        if rows:
+            db.session.execute(db.insert(Message), rows)
+        pending.clear()
+
+    for op in ops:
+        if op[0] == 'add':
+            _, seq, record = op
+            record = msgspec.convert(record, ChatMessage)
+            pending[record.id] = {
+                'id': record.id,
+                'seq': seq,
+                'author': record.pseudo,
+                'recipient': record.recipient,
+                'room': None if record.recipient else record.room,
+                'text': record.text,
+                'timestamp': record.timestamp or time.time(),
+            }
+            continue
+        insert_pending()
+        if op[0] == 'delete':
+            MessageReaction.query.filter_by(message_id=op[1]).delete()
+            Message.query.filter_by(id=op[1]).delete()
+        elif op[0] == 'clear':
+            room = op[1] if len(op) > 1 else DEFAULT_ROOM
+            room_ids = db.select(Message.id).where(room_filter(room))
+            MessageReaction.query.filter(MessageReaction.message_id.in_(room_ids)).delete(synchronize_session=False)
+            Message.query.filter(room_filter(room)).delete(synchronize_session=False)
+        elif op[0] == 'react':
+            _, message_id, emoji, username, reacted_at = op
+            reaction = MessageReaction.query.filter_by(message_id=message_id, emoji=emoji, username=username).first()
+            if reacted_at is None and reaction:
+                db.session.delete(reaction)
+            elif reacted_at is not None and not reaction and db.session.get(Message, message_id):
+                db.session.add(MessageReaction(message_id=message_id, emoji=emoji, username=username, reacted_at=reacted_at))
+            db.session.flush()
+    insert_pending()
+    db.session.commit()
+
+def apply_archive_entries_one_by_one(entries):
+    """Replays a failed batch op by op; ops that still fail are moved to
+    ARCHIVE_DEAD_LETTER_KEY instead of blocking the queue."""
+    for entry in entries:
+        try:
+            apply_archive_ops([codec.decode(entry)])
+        except OperationalError:
+            raise
+        except Exception:
+            db.session.rollback()
+            logger.exception("Opération d'archivage rejetée, déplacée vers %s", ARCHIVE_DEAD_LETTER_KEY)
+            r.rpush(ARCHIVE_DEAD_LETTER_KEY, entry)
+
+def drain_archive_queue():
+    lock = r.lock(ARCHIVE_LOCK_KEY, timeout=30)
+    if not lock.acquire(blocking=False):
+        return 0  # Another worker is draining
+    try:
+        entries = rb.lrange(ARCHIVE_QUEUE_KEY, 0, ARCHIVE_BATCH_SIZE - 1)
+        if entries:
+            try:
+                apply_archive_ops([codec.decode(entry) for entry in entries])
+            except OperationalError:
+                raise  # Database unreachable or locked: retry the batch later
+            except Exception:
+                db.session.rollback()
+                logger.warning("Lot d'archivage en échec, rejoué opération par opération", exc_info=True)
+                apply_archive_entries_one_by_one(entries)
+            r.ltrim(ARCHIVE_QUEUE_KEY, len(entries), -1)
+        return len(entries)
+    finally:
+        lock.release()
+
+def archive_writer():
+    while True:
+        try:
+            with app.app_context():
+                while drain_archive_queue() == ARCHIVE_BATCH_SIZE:
+                    socketio.sleep(0)
+        except Exception:
+            logger.exception("Échec de l'archivage des messages")
+        socketio.sleep(ARCHIVE_FLUSH_INTERVAL)
+
+# Every change to a room's history is sent to that room only and carries a
+# per-room sequence number, so clients can spot a missed event and ask for a
+# fresh snapshot.
+CHAT_EVENT_SEQ_KEY = "chat_event_seq"
+
+def event_seq_key(room):
+    return CHAT_EVENT_SEQ_KEY if room == DEFAULT_ROOM else f"{CHAT_EVENT_SEQ_KEY}:{room}"
+
+def next_event_seq(room=DEFAULT_ROOM):
+    return r.incr(event_seq_key(room))
+
+def emit_message_event(event, payload, conversation=DEFAULT_ROOM, seq=None):
+    """Room changes go to the room with a sequence number (taken here unless
+    the caller already has one); private ones only reach the sockets of the
+    two participants."""
+    if not is_private(conversation):
+        if seq is None:
+            seq = next_event_seq(conversation)
+        emit(event, {**payload, 'room': conversation, 'seq': seq}, room=conversation)
+        metrics.fanout(event, local_audience(conversation))
+        return
+    sids = set().union(*(get_user_sids(username) for username in conversation))
+    for sid in sids:
+        emit(event, payload, room=sid)
+    metrics.fanout(event, len(sids))
+
+def messages_snapshot(room=DEFAULT_ROOM):
+    # Read the sequence first: events racing with the fetch are either already
+    # in the snapshot or carry a higher seq, and every delta is idempotent.
+    seq = int(r.get(event_seq_key(room)) or 0)
+    messages, has_more = get_message_page(conversation=room)
+    return {'room': room, 'seq': seq, 'messages': messages, 'has_more': has_more}
+
+@app.cli.command('import-legacy-messages')
+def import_legacy_messages():
+    """Copie l'ancienne liste Redis `messages` vers le stockage par message."""
+    count = 0
+    for raw in r.lrange('messages', -MAX_MESSAGES, -1):
+        message = msgspec.json.decode(raw, type=ChatMessage)  # The old list was always JSON
+        add_message(message, recipient=message.recipient)
+        for emoji, usernames in message.reactions.items():
+            for username in usernames:
+                toggle_reaction(message.id, emoji, username)
+        count += 1
+    r.delete('messages')
+    click.echo(f"{count} message(s) importé(s).")
+
+@app.cli.command('split-private-messages')
+def split_private_messages():
+    """Déplace les messages privés de l'index public vers leur conversation."""
+    entries = r.zrange(MESSAGE_INDEX_KEY, 0, -1, withscores=True)
+    records = rb.mget([message_key(message_id) for message_id, _ in entries]) if entries else []
+    pipe = r.pipeline()
+    count = 0
+    for (message_id, score), record in zip(entries, records):
+        conversation = conversation_of(codec.decode(record, ChatMessage)) if record else None
+        if conversation:
+            pipe.zrem(MESSAGE_INDEX_KEY, message_id)
+            pipe.zadd(index_key(conversation), {message_id: score})
+            count += 1
+    pipe.execute()
+    click.echo(f"{count} message(s) privé(s) déplacé(s).")
+
+# Typing state is a sorted set of usernames per room, scored by expiry time: a
+# keystroke only refreshes the score. The ticker trims expired entries and
+# publishes each room's set to that room, and the snapshot key makes sure only
+# the first worker to observe a change emits it.
+typing_tick_script = r.register_script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local users = redis.call('ZRANGE', KEYS[1], 0, -1)
+local snapshot = table.concat(users, '\\n')
+if redis.call('GET', KEYS[2]) == snapshot then
+    return false
+end
+redis.call('SET', KEYS[2], snapshot)
+return users
+""")
+
+def typing_key(room):
+    return f"{TYPING_USERS_KEY_PREFIX}{room}"
+
+def mark_typing(username, room):
+    r.zadd(typing_key(room), {username: time.time() + TYPING_TTL})
+
+def clear_typing(username, room):
+    r.zrem(typing_key(room), username)
+
+def get_typing_users(room):
+    return r.zrangebyscore(typing_key(room), time.time(), '+inf')
+
+def typing_ticker():
+    while True:
+        try:
+            now = time.time()
+            for room in CHAT_ROOMS:
+                users = typing_tick_script(keys=[typing_key(room), TYPING_SNAPSHOT_KEY_PREFIX + room], args=[now])
+                if users is not None:
+                    socketio.emit('typing_users', {'room': room, 'users': users}, room=room)
+                    metrics.fanout('typing_users', local_audience(room))
+        except redis.RedisError:
+            logger.exception("Échec de la mise à jour des utilisateurs en train d'écrire")
+        socketio.sleep(TYPING_TICK)
 
 # === SOCKET.IO EVENTS CHAT GLOBAL ===
 
-@socketio.on('connect')
-def handle_connect():
+@on_event('connect')
+def handle_connect(auth=None):
+    start_background_tasks()
     username = session.get('username')
     if not username:
         username = f"Anonyme-{str(uuid.uuid4())[:4]}"
-    add_connected_user(request.sid, username)
-    print(f"Utilisateur {username} connecté avec SID : {request.sid}.")
-    emit('messages', get_messages())
-    emit('user_list', get_connected_users(), broadcast=True)
+    user_info = add_connected_user(request.sid, username)
+    join_room(DEFAULT_ROOM)
+    queue_presence_change(request.sid, 'user_joined', user_info)
+    logger.info("Utilisateur %s connecté avec SID : %s.", username, request.sid)
+    emit('rooms', list(CHAT_ROOMS))
+    emit('messages', messages_snapshot())
+    emit('user_list', presence_snapshot())
 
-@socketio.on('set_username')
+@on_event('switch_room')
+def handle_switch_room(room):
+    if room not in CHAT_ROOMS:
+        return
+    user_info = get_connected_user(request.sid)
+    if not user_info:
+        return
+    if user_info.room != room:
+        leave_room(user_info.room)
+        clear_typing(user_info.username, user_info.room)
+        join_room(room)
+        set_user_room(user_info, room)
+    emit('messages', messages_snapshot(room))
+    emit('typing_users', {'room': room, 'users': get_typing_users(room)})
+
+@on_event('set_username')
 def handle_set_username(new_username):
-    update_username(request.sid, new_username)
-    print(f"SID {request.sid} a mis à jour le nom d'utilisateur vers {new_username}")
-    emit('user_list', get_connected_users(), broadcast=True)
-
-@socketio.on('disconnect')
-def handle_disconnect():
-    user_json = r.hget('connected_users', request.sid)
-    if user_json:
-        username = json.loads(user_json)["username"]
-        print(f"Utilisateur {username} (SID : {request.sid}) déconnecté.")
-    remove_connected_user(request.sid)
-    emit('user_list', get_connected_users(), broadcast=True)
-
-@socketio.on('send_message')
+    if not valid_field(new_username, USERNAME_MAX_LENGTH):
+        return
+    account = session.get('username')
+    # A logged in socket keeps its account name; an anonymous one cannot
+    # borrow a registered name, nor one in use (checked by update_username)
+    if account and new_username != account:
+        logger.debug("Renommage refusé pour %s (connecté en tant que %s)", request.sid, account)
+        return
+    if not account and profile_cache.get(new_username):
+        logger.debug("Renommage refusé pour %s : %s est un compte enregistré", request.sid, new_username)
+        return
+    user_info = update_username(request.sid, new_username)
+    if user_info:
+        queue_presence_change(request.sid, 'user_renamed', user_info)
+        logger.info("SID %s a mis à jour le nom d'utilisateur vers %s", request.sid, new_username)
+
+@on_event('presence_resync')
+def handle_presence_resync():
+    emit('user_list', presence_snapshot())
+
+@on_event('disconnect')
+def handle_disconnect(reason=None):
+    user_info = remove_connected_user(request.sid)
+    if user_info:
+        queue_presence_change(request.sid, 'user_left', user_info)
+        logger.info("Utilisateur %s (SID : %s) déconnecté.", user_info.username, request.sid)
+
+@on_event('send_message')
 def handle_send_message(data):
-    print(f"handle_send_message called with data: {data}")
     text = data.get('text', '').strip()
     if not text or len(text) > 500:
-        print("Invalid text or text length for public message.")
+        logger.debug("Message public refusé (vide ou trop long) de %s", request.sid)
         return
-    user_json = r.hget('connected_users', request.sid)
-    username = "Anonyme"
-    if user_json:
-        username = json.loads(user_json)["username"]
-    message = {
-        'id': str(uuid.uuid4()),
-        'pseudo': username,
-        'text': text,
-        'reactions': {}
-    }
-    print(f"Prepared public message: {message}")
-    add_message(message, recipient=None)  # Public message
-    print("Emitting 'new_message' broadcast=True")
-    emit('new_message', message, broadcast=True)
-
-@socketio.on('send_private_message')
+    user_info = get_connected_user(request.sid)
+    username = user_info.username if user_info else "Anonyme"
+    room = user_info.room if user_info else DEFAULT_ROOM
+    message = ChatMessage(
+        id=str(uuid.uuid4()),
+        pseudo=username,
+        text=text,
+        timestamp=time.time(),
+        room=room,
+    )
+    seq = add_message(message, recipient=None)  # Public message
+    clear_typing(username, room)
+    emit('new_message', {**msgspec.structs.asdict(message), 'seq': seq}, room=room)
+    metrics.fanout('new_message', local_audience(room))
+
+@on_event('send_private_message')
 def handle_send_private_message(data):
-    print(f"handle_send_private_message called with data: {data}")
     text = data.get('text', '').strip()
     recipient = data.get('to')
-    if not text or len(text) > 500 or not recipient:
-        print("Invalid text, text length, or missing recipient for private message.")
+    if not text or len(text) > 500 or not valid_field(recipient, USERNAME_MAX_LENGTH):
+        logger.debug("Message privé refusé (vide, trop long ou sans destinataire) de %s", request.sid)
         return
-    user_json = r.hget('connected_users', request.sid)
-    username = "Anonyme"
-    if user_json:
-        username = json.loads(user_json)["username"]
-    message = {
-        'id': str(uuid.uuid4()),
-        'pseudo': username,
-        'text': text,
-        'reactions': {},
-        'recipient': recipient
-    }
-    print(f"Prepared private message: {message}")
+    user_info = get_connected_user(request.sid)
+    username = user_info.username if user_info else "Anonyme"
+    message = ChatMessage(
+        id=str(uuid.uuid4()),
+        pseudo=username,
+        text=text,
+        timestamp=time.time(),
+        recipient=recipient,
+    )
     add_message(message, recipient=recipient)  # Private message
-    print(f"Emitting 'new_private_message' to sender (room={request.sid})")
-    emit('new_private_message', message, room=request.sid)
-    # Find recipient's SID
-    recipient_sid = None
-    for sid, user_info_json in r.hgetall('connected_users').items():
-        user_info = json.loads(user_info_json)
-        if user_info["username"] == recipient:
-            recipient_sid = sid
-            break
-    if recipient_sid:
-        print(f"Emitting 'new_private_message' to recipient (room={recipient_sid})")
-        emit('new_private_message', message, room=recipient_sid)
-    else:
-        print(f"Recipient {recipient} not found or not connected.")
+    clear_typing(username, user_info.room if user_info else DEFAULT_ROOM)
+    recipient_sids = get_user_sids(recipient)
+    if not recipient_sids:
+        logger.debug("Destinataire %s introuvable ou déconnecté.", recipient)
+    # Every open tab of both participants gets the message, each sid once
+    target_sids = recipient_sids | get_user_sids(username) | {request.sid}
+    for sid in target_sids:
+        emit('new_private_message', message, room=sid)
+    metrics.fanout('new_private_message', len(target_sids))
 
-@socketio.on('delete_message')
+@on_event('delete_message')
 def handle_delete_message(data):
     message_id = data.get('id')
+    username = session.get('username')
+    # Deletions reach the archive too: they are checked here, not only in the UI
     if message_id == "all":
-        r.delete('messages')
-        emit('messages', [], broadcast=True)
+        if not is_admin(username):
+            logger.warning("Effacement du salon refusé pour %s (SID : %s)", username, request.sid)
+            return
+        user_info = get_connected_user(request.sid)
+        room = user_info.room if user_info else DEFAULT_ROOM
+        clear_messages(room)
+        emit('messages_cleared', {'room': room, 'seq': next_event_seq(room)}, room=room)
+        metrics.fanout('messages_cleared', local_audience(room))
         return
-    messages = [m for m in get_messages() if m['id'] != message_id]
-    r.delete('messages')
-    for m in messages:
-        r.rpush('messages', json.dumps(m))
-    emit('messages', messages, broadcast=True)
+    if not message_id:
+        return
+    conversation, author = locate_message(message_id)
+    if conversation is None:
+        return
+    if not username or (author != username and not is_admin(username)):
+        logger.warning("Suppression du message %s refusée pour %s", message_id, username)
+        return
+    delete_message(message_id, conversation)
+    emit_message_event('message_deleted', {'id': message_id}, conversation)
+
+@on_event('fetch_history')
+def handle_fetch_history(data):
+    try:
+        limit = int(data.get('limit') or HISTORY_PAGE_SIZE)
+    except (TypeError, ValueError):
+        limit = HISTORY_PAGE_SIZE
+    limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+    conversation = data.get('room') if data.get('room') in CHAT_ROOMS else DEFAULT_ROOM
+    if data.get('with'):
+        # Only an authenticated participant can read a private conversation
+        username = session.get('username')
+        if not username:
+            return {'messages': [], 'has_more': False}
+        conversation = conversation_key(username, data['with'])
+    messages, has_more = get_message_page(data.get('before_id'), limit, conversation)
+    return {'messages': messages, 'has_more': has_more}
+
+@on_event('resync')
+def handle_resync():
+    user_info = get_connected_user(request.sid)
+    emit('messages', messages_snapshot(user_info.room if user_info else DEFAULT_ROOM))
 
-@socketio.on('user_typing')
+@on_event('user_typing')
 def handle_user_typing(data):
-    pseudo = data.get('pseudo')
-    emit('user_typing', {'pseudo': pseudo}, broadcast=True, include_self=False)
+    pseudo = session.get('username') or data.get('pseudo')
+    user_info = get_connected_user(request.sid)
+    if valid_field(pseudo, USERNAME_MAX_LENGTH) and user_info:
+        mark_typing(pseudo, user_info.room)
 
-@socketio.on('react_message')
+@on_event('react_message')
 def handle_react_message(data):
     message_id = data.get('messageId')
     emoji = data.get('emoji')
     username = session.get('username', 'Anonyme')
-    messages = [json.loads(m) for m in r.lrange('messages', -MAX_MESSAGES, -1)]
-    found = False
-    for msg in messages:
-        if msg['id'] == message_id:
-            if 'reactions' not in msg:
-                msg['reactions'] = {}
-            if emoji not in msg['reactions']:
-                msg['reactions'][emoji] = []
-            if username in msg['reactions'][emoji]:
-                msg['reactions'][emoji].remove(username)
-                if not msg['reactions'][emoji]:
-                    del msg['reactions'][emoji]
-            else:
-                msg['reactions'][emoji].append(username)
-            found = True
-            break
-    if found:
-        r.delete('messages')
-        for m in messages:
-            r.rpush('messages', json.dumps(m))
-        emit('messages', messages, broadcast=True)
+    if not message_id or not valid_field(emoji, EMOJI_MAX_LENGTH):
+        return
+    # A message never changes conversation, so looking it up first cannot race
+    conversation, _ = locate_message(message_id)
+    if conversation is None:
+        return
+    result = toggle_reaction(message_id, emoji, username, conversation)
+    if result is not None:
+        users, seq = result
+    else:
+        users, seq = toggle_archived_reaction(message_id, emoji, username), None
+        if users is None:
+            return
+    emit_message_event('reaction_updated', {'id': message_id, 'emoji': emoji, 'users': users}, conversation, seq)
 
  # === LANCEMENT DU SERVEUR ===
-    
+
+# Started by the first request or socket served by this process (gunicorn
+# imports the module without running __main__), never by `flask` CLI commands.
+background_tasks_started = False
+
+def start_background_tasks():
+    global background_tasks_started
+    if background_tasks_started:
+        return
+    background_tasks_started = True
+    for task in (presence_heartbeat, presence_flusher, archive_writer, visitors_janitor,
+                 typing_ticker, profile_invalidation_listener):
+        socketio.start_background_task(task)
+
+@app.before_request
+def ensure_background_tasks():
+    start_background_tasks()
+
 if __name__ == '__main__':
-        print("Eventlet utilisé :", socketio.async_mode)
+        logger.info("Eventlet utilisé : %s", socketio.async_mode)
+        start_background_tasks()
         socketio.run(app, host='0.0.0.0', port=port)
\ No newline at end of file
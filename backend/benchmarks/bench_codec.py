@@ -0,0 +1,59 @@
+"""Compare the stdlib json path with the msgspec codec on a 500-message history.
+
+Usage (from backend/): python benchmarks/bench_codec.py [--messages 500] [--repeat 200]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from codec import ChatMessage, Codec  # noqa: E402
+
+
+def make_history(count):
+    history = []
+    for i in range(count):
+        message = {
+            'id': str(uuid.uuid4()),
+            'pseudo': f"user{i % 40}",
+            'text': f"Message numéro {i} avec un peu de texte pour ressembler au chat 🙂",
+            'timestamp': time.time(),
+        }
+        if i % 10 == 0:
+            message['recipient'] = f"user{(i + 1) % 40}"
+        history.append(message)
+    return history
+
+
+def bench(label, encode, decode, records, repeat):
+    blobs = [encode(record) for record in records]
+    encode_time = timeit.timeit(lambda: [encode(record) for record in records], number=repeat) / repeat
+    decode_time = timeit.timeit(lambda: [decode(blob) for blob in blobs], number=repeat) / repeat
+    size = sum(len(blob) for blob in blobs)
+    print(f"{label:<16} encode {encode_time * 1e3:8.3f} ms   decode {decode_time * 1e3:8.3f} ms   {size:>8} bytes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    history = make_history(args.messages)
+    structs = [ChatMessage(**message) for message in history]
+    json_codec = Codec('json')
+    msgpack_codec = Codec('msgpack')
+
+    print(f"{args.messages} messages, {args.repeat} runs (time per full history)")
+    bench('stdlib json', json.dumps, json.loads, history, args.repeat)
+    bench('msgspec json', json_codec.encode, lambda blob: json_codec.decode(blob, ChatMessage), structs, args.repeat)
+    bench('msgspec msgpack', msgpack_codec.encode, lambda blob: msgpack_codec.decode(blob, ChatMessage), structs, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Measure how late the eventlet hub runs chat-sized work during a login burst.
+
+A ticker greenlet stands in for chat traffic: it asks to wake every few
+milliseconds and records how late it actually ran. A burst of password
+hashes is fired either inline on the hub or through ``hashing.offload_hash``.
+
+Usage (from backend/): python benchmarks/bench_login_burst.py [--logins 40] [--interval 0.005]
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse  # noqa: E402
+import os  # noqa: E402
+import statistics  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import check_password_hash, generate_password_hash  # noqa: E402
+
+from hashing import hash_stats, verify_password  # noqa: E402
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run(label, check, stored, logins, interval):
+    lags = []
+    done = []
+
+    def ticker():
+        while not done:
+            expected = time.perf_counter() + interval
+            eventlet.sleep(interval)
+            lags.append((time.perf_counter() - expected) * 1000)
+
+    def login():
+        check(stored, 'secret')
+
+    tick = eventlet.spawn(ticker)
+    eventlet.sleep(interval * 10)  # baseline samples before the burst
+    start = time.perf_counter()
+    pool = eventlet.GreenPool(logins)
+    for _ in range(logins):
+        pool.spawn(login)
+    pool.waitall()
+    elapsed = time.perf_counter() - start
+    done.append(True)
+    tick.wait()
+    print(f"{label:<8} burst {elapsed:6.2f}s  hub lag p50 {statistics.median(lags):7.2f} ms  "
+          f"p99 {percentile(lags, 99):7.2f} ms  max {max(lags):7.2f} ms  ({len(lags)} ticks)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=40)
+    parser.add_argument('--interval', type=float, default=0.005)
+    args = parser.parse_args()
+
+    stored = generate_password_hash('secret')
+    run('inline', check_password_hash, stored, args.logins, args.interval)
+    run('offload', verify_password, stored, args.logins, args.interval)
+    print(f"hash pool: {hash_stats}")
+
+
+if __name__ == '__main__':
+    main()
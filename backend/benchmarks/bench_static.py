@@ -0,0 +1,59 @@
+"""Requests per second for the SPA index and a hashed asset, against a running server.
+
+Usage (from backend/, server started separately):
+    python benchmarks/bench_static.py [--url http://localhost:5000] [--duration 5] [--concurrency 10]
+"""
+import argparse
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def hammer(url, headers, deadline):
+    session = requests.Session()
+    count = 0
+    nbytes = 0
+    while time.perf_counter() < deadline:
+        resp = session.get(url, headers=headers)
+        resp.raise_for_status()
+        count += 1
+        # Bytes on the wire: requests has already decoded compressed bodies
+        nbytes += int(resp.headers.get('Content-Length', len(resp.content)))
+    return count, nbytes
+
+
+def run(label, url, headers, duration, concurrency):
+    deadline = time.perf_counter() + duration
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda _: hammer(url, headers, deadline), range(concurrency)))
+    count = sum(c for c, _ in results)
+    nbytes = sum(b for _, b in results)
+    print(f"{label:<40} {count / duration:8.0f} req/s  {nbytes / count / 1024:8.1f} KiB/resp on the wire")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args()
+
+    index = requests.get(args.url + '/')
+    asset = re.search(r'src="\.?/?(assets/[^"]+\.js)"', index.text)
+    targets = [('index', args.url + '/'), ('spa route', args.url + '/tchat')]
+    if asset:
+        targets.append((asset.group(1), f"{args.url}/{asset.group(1)}"))
+    # requests sends "Accept-Encoding: gzip, deflate" by default
+    variants = [('identity', {'Accept-Encoding': 'identity'}), ('gzip', {})]
+    for name, url in targets:
+        for encoding, headers in variants:
+            run(f"{name} [{encoding}]", url, headers, args.duration, args.concurrency)
+        etag = requests.get(url).headers.get('ETag')
+        if etag:
+            run(f"{name} [304]", url, {'If-None-Match': etag}, args.duration, args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Simulate N Socket.IO clients chatting, reacting and typing against a running server.
+
+Each client measures round trips as the other clients see them: a message is
+timed until its own new_message comes back, a reaction until its
+reaction_updated, a typing burst until the client appears in typing_users,
+and fetch_history until its ack. The server's own /metrics are printed
+after the run when --metrics-token (or METRICS_TOKEN) matches the server's.
+
+Usage (from backend/, server started separately against a local Redis):
+    python benchmarks/loadgen.py [--url http://localhost:5000] [--clients 20] [--duration 30] [--rate 1]
+
+The websocket transport needs the websocket-client package; without it the
+clients fall back to long polling. The URL must be one of the origins the
+server accepts.
+"""
+import argparse
+import os
+import random
+import threading
+import time
+import uuid
+
+import requests
+import socketio
+
+ACTIONS = [('send_message', 0.5), ('react_message', 0.2), ('user_typing', 0.2), ('fetch_history', 0.1)]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class LoadClient:
+    def __init__(self, index, url, rooms, results, lock):
+        self.name = f"load-{index}"
+        self.emoji = f"e{index}"  # Unique per client, so reaction echoes are unambiguous
+        self.url = url
+        self.room = rooms[index % len(rooms)] if rooms else None
+        self.results = results
+        self.lock = lock
+        self.pending = {}
+        self.message_ids = []
+        self.typing_visible = False
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('new_message', self.on_new_message)
+        self.sio.on('reaction_updated', self.on_reaction_updated)
+        self.sio.on('typing_users', self.on_typing_users)
+
+    def record(self, event, started):
+        with self.lock:
+            self.results.setdefault(event, []).append(time.perf_counter() - started)
+
+    def resolve(self, key, event):
+        started = self.pending.pop(key, None)
+        if started is not None:
+            self.record(event, started)
+
+    def on_new_message(self, message):
+        self.message_ids = (self.message_ids + [message['id']])[-50:]
+        self.resolve(('send_message', message['text']), 'send_message')
+
+    def on_reaction_updated(self, payload):
+        self.resolve(('react_message', payload['id'], payload['emoji']), 'react_message')
+
+    def on_typing_users(self, payload):
+        self.typing_visible = self.name in payload['users']
+        if self.typing_visible:
+            self.resolve(('user_typing',), 'user_typing')
+
+    def connect(self):
+        started = time.perf_counter()
+        self.sio.connect(self.url, transports=['websocket', 'polling'])
+        self.record('connect', started)
+        if self.room:
+            self.sio.emit('switch_room', self.room)
+
+    def act(self, action):
+        now = time.perf_counter()
+        if action == 'send_message':
+            text = f"{self.name} {uuid.uuid4().hex[:8]}"
+            self.pending[('send_message', text)] = now
+            self.sio.emit('send_message', {'text': text})
+        elif action == 'react_message' and self.message_ids:
+            message_id = random.choice(self.message_ids)
+            self.pending[('react_message', message_id, self.emoji)] = now
+            self.sio.emit('react_message', {'messageId': message_id, 'emoji': self.emoji})
+        elif action == 'user_typing':
+            # The typing set is only published when it changes
+            if not self.typing_visible:
+                self.pending.setdefault(('user_typing',), now)
+            self.sio.emit('user_typing', {'pseudo': self.name})
+        elif action == 'fetch_history':
+            self.sio.call('fetch_history', {'limit': 50, 'room': self.room}, timeout=30)
+            self.record('fetch_history', now)
+
+    def run(self, deadline, rate):
+        names, weights = zip(*ACTIONS)
+        while time.perf_counter() < deadline:
+            time.sleep(random.expovariate(rate))
+            self.act(random.choices(names, weights)[0])
+        time.sleep(1)  # Let the last echoes arrive
+        lost = len(self.pending)
+        self.sio.disconnect()
+        return lost
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--rate', type=float, default=1, help="actions per second per client")
+    parser.add_argument('--rooms', default='', help="comma separated rooms to spread clients over")
+    parser.add_argument('--metrics-token', default=os.environ.get('METRICS_TOKEN'))
+    args = parser.parse_args()
+
+    results = {}
+    lock = threading.Lock()
+    rooms = [room for room in args.rooms.split(',') if room]
+    clients = [LoadClient(i, args.url, rooms, results, lock) for i in range(args.clients)]
+    for client in clients:
+        client.connect()
+
+    deadline = time.perf_counter() + args.duration
+    lost = [0] * len(clients)
+
+    def worker(i):
+        lost[i] = clients[i].run(deadline, args.rate)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(clients))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(f"{args.clients} clients, {args.duration:.0f}s, {args.rate} action/s/client — client-side round trips")
+    print(f"{'event':<16} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for event, values in sorted(results.items()):
+        print(f"{event:<16} {len(values):>7} {percentile(values, 50) * 1000:>9.1f} "
+              f"{percentile(values, 99) * 1000:>9.1f} {max(values) * 1000:>9.1f}")
+    print(f"unanswered: {sum(lost)}")
+
+    if not args.metrics_token:
+        return
+    try:
+        response = requests.get(args.url + '/metrics', timeout=5,
+                                headers={'Authorization': f"Bearer {args.metrics_token}"})
+        server = response.json() if response.ok else None
+    except (requests.RequestException, ValueError):
+        return
+    if server is None:
+        print(f"\n/metrics: {response.status_code}")
+        return
+    print(f"\nserver handlers (worker {server['worker']})")
+    for key, summary in server['latency_ms'].items():
+        if key.startswith('socketio:'):
+            calls = server['redis'].get(key, {})
+            print(f"{key:<32} {summary['count']:>7} p50 {summary['p50']:>7.1f} p99 {summary['p99']:>7.1f} ms  "
+                  f"redis {calls.get('round_trips', 0) / summary['count']:.1f} rt/call")
+
+
+if __name__ == '__main__':
+    main()
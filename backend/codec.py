@@ -0,0 +1,89 @@
+# === ENCODAGE DES DONNÉES REDIS & SOCKET.IO (msgspec) ===
+import os
+
+import msgspec
+
+# Public messages and sockets belong to a chat room; records written before
+# rooms existed decode into the default one.
+DEFAULT_ROOM = 'general'
+
+
+class ChatMessage(msgspec.Struct, omit_defaults=True):
+    id: str
+    pseudo: str
+    text: str
+    timestamp: float = 0.0
+    recipient: str | None = None
+    room: str = DEFAULT_ROOM
+    reactions: dict[str, list[str]] = {}
+
+
+class ConnectedUser(msgspec.Struct, omit_defaults=True):
+    username: str
+    connected_at: float
+    sid: str
+    worker: str | None = None
+    room: str = DEFAULT_ROOM
+    avatar_url: str | None = None
+
+
+JSON_FIRST_BYTES = frozenset(b'{["')
+
+
+def is_json(data):
+    return bool(data) and memoryview(data)[0] in JSON_FIRST_BYTES
+
+
+class Codec:
+    """Encoder/decoder shared by everything stored in Redis.
+
+    ``json`` keeps payloads readable (and compatible with records written by
+    the stdlib ``json`` module); ``msgpack`` is more compact on the wire.
+    Decoders are built once per target type and reused.
+
+    With ``fallback``, data written in the fallback format is decoded in it,
+    so records written before REDIS_CODEC was switched stay readable. The
+    format is told from the first byte: everything stored is a map or an
+    array, which starts with ``{``, ``[`` or ``"`` in JSON and never does in
+    msgpack.
+    """
+
+    def __init__(self, fmt='json', fallback=None):
+        if fmt not in ('json', 'msgpack'):
+            raise ValueError(f"Unknown codec format: {fmt}")
+        self.format = fmt
+        self._module = msgspec.msgpack if fmt == 'msgpack' else msgspec.json
+        self._encoder = self._module.Encoder()
+        self._decoders = {}
+        self._fallback = Codec(fallback) if fallback else None
+
+    def encode(self, obj):
+        return self._encoder.encode(obj)
+
+    def decode(self, data, type=object):
+        if self._fallback is not None and is_json(data) != (self.format == 'json'):
+            return self._fallback.decode(data, type)
+        decoder = self._decoders.get(type)
+        if decoder is None:
+            decoder = self._decoders[type] = self._module.Decoder(type)
+        return decoder.decode(data)
+
+
+REDIS_CODEC = os.environ.get('REDIS_CODEC', 'json')
+codec = Codec(REDIS_CODEC, fallback='msgpack' if REDIS_CODEC == 'json' else 'json')
+
+# Text-safe encoder for values that end up in Redis field names or Socket.IO
+# packets, whatever the storage format.
+json_codec = Codec('json')
+
+
+class SocketIOJSON:
+    """Drop-in for the ``json`` module used by python-socketio packets."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return json_codec.encode(obj).decode()
+
+    @staticmethod
+    def loads(data, **kwargs):
+        return json_codec.decode(data)
@@ -0,0 +1,46 @@
+# === HACHAGE DES MOTS DE PASSE HORS DU HUB EVENTLET ===
+import os
+
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# scrypt/PBKDF2 release the GIL, so native threads keep the hub responsive.
+HASH_CONCURRENCY = int(os.environ.get('HASH_CONCURRENCY', 4))
+HASH_MAX_WAITING = int(os.environ.get('HASH_MAX_WAITING', 100))
+
+hash_slots = Semaphore(HASH_CONCURRENCY)
+hash_stats = {'running': 0, 'waiting': 0, 'max_waiting': 0, 'completed': 0, 'rejected': 0}
+
+
+class HashQueueFull(Exception):
+    pass
+
+
+def offload_hash(func, *args):
+    """Runs `func` in eventlet's native thread pool, at most HASH_CONCURRENCY
+    at a time. Raises HashQueueFull when too many calls are already waiting."""
+    if hash_stats['waiting'] >= HASH_MAX_WAITING:
+        hash_stats['rejected'] += 1
+        raise HashQueueFull()
+    hash_stats['waiting'] += 1
+    hash_stats['max_waiting'] = max(hash_stats['max_waiting'], hash_stats['waiting'])
+    try:
+        hash_slots.acquire()
+    finally:
+        hash_stats['waiting'] -= 1
+    hash_stats['running'] += 1
+    try:
+        return tpool.execute(func, *args)
+    finally:
+        hash_stats['running'] -= 1
+        hash_stats['completed'] += 1
+        hash_slots.release()
+
+
+def hash_password(password):
+    return offload_hash(generate_password_hash, password)
+
+
+def verify_password(password_hash, password):
+    return offload_hash(check_password_hash, password_hash, password)
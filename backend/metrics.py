@@ -0,0 +1,142 @@
+# === INSTRUMENTATION (LATENCES, APPELS REDIS, FAN-OUT) ===
+import functools
+import threading
+import time
+
+import redis
+
+# Log-spaced bucket upper bounds: 0.1 ms doubling up to ~100 s for latencies,
+# 1 doubling up to ~1M for sizes.
+LATENCY_BUCKETS = [0.0001 * 2 ** i for i in range(21)]
+SIZE_BUCKETS = [2 ** i for i in range(21)]
+
+
+class Histogram:
+    """Fixed-bucket histogram: constant memory, approximate quantiles
+    (the upper bound of the bucket holding the quantile)."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self, scale=1):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count * scale if self.count else 0.0,
+            'p50': self.quantile(0.5) * scale,
+            'p99': self.quantile(0.99) * scale,
+            'max': self.max * scale,
+        }
+
+
+class Metrics:
+    """Per-process registry. Redis commands are attributed to the handler or
+    route running in the current greenlet, or to 'background' outside one."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.fanouts = {}
+        self.errors = {}
+        self.redis_calls = {}
+        self._current = threading.local()  # Greenlet-local once eventlet is patched
+
+    def timed(self, kind, name):
+        key = f"{kind}:{name}"
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                self.begin(key)
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    self.count_error(key)
+                    raise
+                finally:
+                    self.end()
+            return wrapper
+        return decorator
+
+    def begin(self, key):
+        self._current.key = key
+        self._current.started = time.perf_counter()
+
+    def end(self):
+        key = getattr(self._current, 'key', None)
+        if key is None:
+            return
+        elapsed = time.perf_counter() - self._current.started
+        self._current.key = None
+        histogram = self.latencies.get(key)
+        if histogram is None:
+            histogram = self.latencies[key] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(elapsed)
+
+    def count_error(self, key):
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def fanout(self, event, size):
+        histogram = self.fanouts.get(event)
+        if histogram is None:
+            histogram = self.fanouts[event] = Histogram(SIZE_BUCKETS)
+        histogram.observe(size)
+
+    def count_redis(self, commands):
+        key = getattr(self._current, 'key', None) or 'background'
+        calls = self.redis_calls.get(key)
+        if calls is None:
+            calls = self.redis_calls[key] = {'round_trips': 0, 'commands': 0}
+        calls['round_trips'] += 1
+        calls['commands'] += commands
+
+    def snapshot(self):
+        return {
+            'latency_ms': {key: h.summary(scale=1000) for key, h in sorted(self.latencies.items())},
+            'errors': dict(sorted(self.errors.items())),
+            'fanout': {event: h.summary() for event, h in sorted(self.fanouts.items())},
+            'redis': dict(sorted(self.redis_calls.items())),
+        }
+
+
+metrics = Metrics()
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        if self.command_stack:
+            metrics.count_redis(len(self.command_stack))
+        return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.Redis):
+    """redis.Redis counting round trips and commands; a pipeline is one round trip."""
+
+    def execute_command(self, *args, **options):
+        metrics.count_redis(1)
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
@@ -16,25 +16,105 @@ interface Message {
   text: string;
   reactions?: { [emoji: string]: string[] };
   recipient?: string; // Added for private messages
+  room?: string;
 }
 
 interface User {
   username: string;
   connected_at: string;
   avatar_url?: string;
+  sid: string;
+}
+
+interface MessagesSnapshot {
+  room: string;
+  seq: number;
+  messages: Message[];
+  has_more: boolean;
+}
+
+interface HistoryPage {
+  messages: Message[];
+  has_more: boolean;
+}
+
+interface Conversation {
+  messages: Message[];
+  hasMore: boolean;
+  loaded: boolean; // false until the latest page has been fetched
+}
+
+const HISTORY_PAGE_SIZE = 50;
+const TYPING_EMIT_INTERVAL = 1000; // the server keeps a typist for 3 seconds
+
+function withReaction(list: Message[], id: string, emoji: string, users: string[]) {
+  return list.map(m => {
+    if (m.id !== id) return m;
+    const reactions = { ...(m.reactions || {}) };
+    if (users.length > 0) {
+      reactions[emoji] = users;
+    } else {
+      delete reactions[emoji];
+    }
+    return { ...m, reactions };
+  });
+}
+
+function mapConversations(
+  conversations: { [username: string]: Conversation },
+  update: (messages: Message[]) => Message[],
+) {
+  const next: { [username: string]: Conversation } = {};
+  for (const [username, conversation] of Object.entries(conversations)) {
+    next[username] = { ...conversation, messages: update(conversation.messages) };
+  }
+  return next;
+}
+
+interface PresenceSnapshot {
+  version: number;
+  users: User[];
+}
+
+type PresenceEvent =
+  | { type: 'user_joined' | 'user_renamed'; user: User }
+  | { type: 'user_left'; sid: string; username: string };
+
+function applyPresenceEvents(users: User[], events: PresenceEvent[]) {
+  let next = users;
+  for (const event of events) {
+    if (event.type === 'user_left') {
+      next = next.filter(u => u.sid !== event.sid);
+    } else {
+      next = [...next.filter(u => u.sid !== event.user.sid), event.user];
+    }
+  }
+  return next;
 }
 
 export default function Chat() {
   const [messages, setMessages] = useState<Message[]>([]);
+  const [hasMoreHistory, setHasMoreHistory] = useState(false);
+  const [loadingHistory, setLoadingHistory] = useState(false);
+  const [conversations, setConversations] = useState<{ [username: string]: Conversation }>({});
+  const requestedConversationsRef = useRef(new Set<string>());
   const [newMessage, setNewMessage] = useState('');
   const [connected, setConnected] = useState(true);
   const [pseudo, setPseudo] = useState<string | null>(null);
   const [loading, setLoading] = useState(true);
-  const [typingUsers, setTypingUsers] = useState<Map<string, number>>(new Map<string, number>());
+  const [typingUsers, setTypingUsers] = useState<string[]>([]);
+  const [rooms, setRooms] = useState<string[]>([]);
+  const [currentRoom, setCurrentRoom] = useState<string | null>(null);
+  // Room events are only sent to the room's members, but a few can still
+  // arrive from the previous room right after a switch.
+  const currentRoomRef = useRef<string | null>(null);
+  const lastTypingEmitRef = useRef(0);
   const [reactingTo, setReactingTo] = useState<string | null>(null);
   const [sidebarOpen, setSidebarOpen] = useState(false);
   const [privateChatRecipient, setPrivateChatRecipient] = useState<string | null>(null);
   const socketRef = useRef<Socket | null>(null);
+  const lastSeqRef = useRef(0);
+  const presenceVersionRef = useRef(0);
   const messagesEndRef: React.RefObject<HTMLDivElement | null> = useRef(null);
   const [onlineUsers, setOnlineUsers] = useState<User[]>([]);
   const [avatarCache, setAvatarCache] = useState<{ [username: string]: string }>({});
@@ -87,12 +167,38 @@ export default function Chat() {
     });
     socketRef.current = socket;
 
-    socket.on('messages', (msgs: Message[]) => {
-      setMessages(msgs.slice(-100));
+    // Returns false for events already covered by the last snapshot, and
+    // asks for a new snapshot when one or more events were missed.
+    const acceptSeq = (seq: number) => {
+      if (seq <= lastSeqRef.current) return false;
+      if (seq > lastSeqRef.current + 1) {
+        socket.emit('resync');
+      }
+      lastSeqRef.current = seq;
+      return true;
+    };
+
+    socket.on('rooms', (names: string[]) => setRooms(names));
+
+    // Sequence numbers are per room: the snapshot of the room being shown
+    // resets them.
+    const inCurrentRoom = (room?: string) => room === currentRoomRef.current;
+
+    socket.on('messages', (snapshot: MessagesSnapshot) => {
+      if (currentRoomRef.current === null) {
+        currentRoomRef.current = snapshot.room;
+        setCurrentRoom(snapshot.room);
+      }
+      if (!inCurrentRoom(snapshot.room)) return;
+      lastSeqRef.current = snapshot.seq;
+      setMessages(snapshot.messages);
+      setHasMoreHistory(snapshot.has_more);
     });
 
-    socket.on('new_message', (message: Message) => {
+    socket.on('new_message', (message: Message & { seq: number }) => {
+      if (!inCurrentRoom(message.room) || !acceptSeq(message.seq)) return;
       setMessages(prev => {
+        if (prev.some(m => m.id === message.id)) return prev;
         // Only process public messages here
         if (!message.recipient) {
           if (!document.hasFocus() && Notification.permission === 'granted') {
@@ -101,22 +207,46 @@ export default function Chat() {
               icon: '/default-avatar.jpg',
             });
           }
-          return [...prev.slice(-99), message];
+          return [...prev, message];
         } else {
           // If it's a private message, add it to the state regardless
-          return [...prev.slice(-99), message];
+          return [...prev, message];
         }
       });
       messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
     });
 
+    // Room deltas carry a room and a seq; private ones are sent to the two
+    // participants only and have neither.
+    socket.on('message_deleted', ({ id, room, seq }: { id: string; room?: string; seq?: number }) => {
+      if (seq === undefined) {
+        setConversations(prev => mapConversations(prev, list => list.filter(m => m.id !== id)));
+        return;
+      }
+      if (!inCurrentRoom(room) || !acceptSeq(seq)) return;
+      setMessages(prev => prev.filter(m => m.id !== id));
+    });
+
+    socket.on('messages_cleared', ({ room, seq }: { room: string; seq: number }) => {
+      if (!inCurrentRoom(room) || !acceptSeq(seq)) return;
+      setMessages([]);
+    });
+
+    socket.on('reaction_updated', ({ id, emoji, users, room, seq }: { id: string; emoji: string; users: string[]; room?: string; seq?: number }) => {
+      if (seq === undefined) {
+        setConversations(prev => mapConversations(prev, list => withReaction(list, id, emoji, users)));
+        return;
+      }
+      if (!inCurrentRoom(room) || !acceptSeq(seq)) return;
+      setMessages(prev => withReaction(prev, id, emoji, users));
+    });
+
     socket.on('new_private_message', (message: Message) => {
-      console.log("Frontend: Received new_private_message:", message);
-      setMessages(prev => {
-        console.log("Frontend: Messages before update:", prev);
-        const newMessages = [...prev.slice(-99), message];
-        console.log("Frontend: Messages after update:", newMessages);
-        return newMessages;
+      const other = message.pseudo === pseudo ? message.recipient! : message.pseudo;
+      setConversations(prev => {
+        const conversation = prev[other] ?? { messages: [], hasMore: false, loaded: false };
+        if (conversation.messages.some(m => m.id === message.id)) return prev;
+        return { ...prev, [other]: { ...conversation, messages: [...conversation.messages, message] } };
       });
       // Trigger notification if window is not focused and permission is granted
       if (!document.hasFocus() && Notification.permission === 'granted') {
@@ -133,17 +263,45 @@ export default function Chat() {
       if (pseudo) {
         socket.emit('set_username', pseudo);
       }
+      // A new connection starts in the default room
+      if (currentRoomRef.current !== null) {
+        socket.emit('switch_room', currentRoomRef.current);
+      }
     });
 
     socket.on('disconnect', () => setConnected(false));
     socket.on('connect_error', () => setConnected(false));
-    socket.on('user_list', (userList: User[]) => setOnlineUsers(userList));
-    socket.on('typing', (username: string) => {
-      setTypingUsers(prev => {
-        const newMap = new Map(prev);
-        newMap.set(username, Date.now());
-        return newMap;
-      });
+    socket.on('user_list', (snapshot: PresenceSnapshot) => {
+      presenceVersionRef.current = snapshot.version;
+      setOnlineUsers(snapshot.users);
+    });
+
+    // Same gap detection as the message sequence, on the presence version.
+    const applyPresence = (version: number, events: PresenceEvent[]) => {
+      if (version <= presenceVersionRef.current) return;
+      if (version > presenceVersionRef.current + 1) {
+        socket.emit('presence_resync');
+      }
+      presenceVersionRef.current = version;
+      setOnlineUsers(prev => applyPresenceEvents(prev, events));
+    };
+
+    socket.on('user_joined', ({ user, version }: { user: User; version: number }) => {
+      applyPresence(version, [{ type: 'user_joined', user }]);
+    });
+    socket.on('user_renamed', ({ user, version }: { user: User; version: number }) => {
+      applyPresence(version, [{ type: 'user_renamed', user }]);
+    });
+    socket.on('user_left', ({ sid, username, version }: { sid: string; username: string; version: number }) => {
+      applyPresence(version, [{ type: 'user_left', sid, username }]);
+    });
+    socket.on('presence_batch', ({ events, version }: { events: PresenceEvent[]; version: number }) => {
+      applyPresence(version, events);
+    });
+    // The server expires idle typists and only sends the set when it changes
+    socket.on('typing_users', ({ room, users }: { room: string; users: string[] }) => {
+      if (!inCurrentRoom(room)) return;
+      setTypingUsers(users.filter(u => u !== pseudo));
     });
 
     return () => {
@@ -155,9 +313,83 @@ export default function Chat() {
     };
   }, [pseudo]);
 
+  const activeConversation = privateChatRecipient ? conversations[privateChatRecipient] : undefined;
+  const activeMessages = privateChatRecipient ? activeConversation?.messages ?? [] : messages;
+  const activeHasMore = privateChatRecipient ? activeConversation?.hasMore ?? false : hasMoreHistory;
+
+  // Only follow the bottom when a message is appended, not when an older
+  // page is prepended or a reaction changes.
+  const lastMessageId = activeMessages.length > 0 ? activeMessages[activeMessages.length - 1].id : null;
   useEffect(() => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
-  }, [messages]);
+  }, [lastMessageId]);
+
+  // A private conversation's history is fetched the first time it is opened
+  useEffect(() => {
+    const socket = socketRef.current;
+    const recipient = privateChatRecipient;
+    if (!socket || !recipient || requestedConversationsRef.current.has(recipient)) return;
+    requestedConversationsRef.current.add(recipient);
+    socket.emit('fetch_history', { with: recipient, limit: HISTORY_PAGE_SIZE }, (page: HistoryPage) => {
+      setConversations(prev => {
+        const live = prev[recipient]?.messages ?? [];
+        const known = new Set(page.messages.map(m => m.id));
+        return {
+          ...prev,
+          [recipient]: {
+            messages: [...page.messages, ...live.filter(m => !known.has(m.id))],
+            hasMore: page.has_more,
+            loaded: true,
+          },
+        };
+      });
+    });
+  }, [privateChatRecipient, connected]);
+
+  const loadOlderMessages = useCallback(() => {
+    const socket = socketRef.current;
+    if (!socket || loadingHistory || !activeHasMore || activeMessages.length === 0) return;
+    if (privateChatRecipient && !activeConversation?.loaded) return;
+    const recipient = privateChatRecipient;
+    const room = currentRoom;
+    const prepend = (prev: Message[], older: Message[]) => {
+      const known = new Set(prev.map(m => m.id));
+      return [...older.filter(m => !known.has(m.id)), ...prev];
+    };
+    setLoadingHistory(true);
+    socket.emit('fetch_history', {
+      before_id: activeMessages[0].id,
+      limit: HISTORY_PAGE_SIZE,
+      with: recipient ?? undefined,
+      room: room ?? undefined,
+    }, (page: HistoryPage) => {
+      if (recipient) {
+        setConversations(prev => ({
+          ...prev,
+          [recipient]: { ...prev[recipient], messages: prepend(prev[recipient].messages, page.messages), hasMore: page.has_more },
+        }));
+      } else if (room === currentRoomRef.current) {
+        setMessages(prev => prepend(prev, page.messages));
+        setHasMoreHistory(page.has_more);
+      }
+      setLoadingHistory(false);
+    });
+  }, [activeMessages, activeHasMore, activeConversation, privateChatRecipient, currentRoom, loadingHistory]);
+
+  // Switching rooms reuses the socket: the server moves it to the new room
+  // and answers with that room's snapshot and typists.
+  const switchRoom = (room: string) => {
+    setPrivateChatRecipient(null);
+    setSidebarOpen(false);
+    if (room === currentRoomRef.current) return;
+    currentRoomRef.current = room;
+    lastSeqRef.current = 0;
+    setCurrentRoom(room);
+    setMessages([]);
+    setHasMoreHistory(false);
+    setTypingUsers([]);
+    socketRef.current?.emit('switch_room', room);
+  };
 
   const sendMessage = (recipient: string | null) => {
     if (newMessage.trim() === '' || !socketRef.current || !socketRef.current.connected) return;
@@ -178,6 +410,9 @@ export default function Chat() {
     }).finally(() => {
       setPseudo(null);
       setMessages([]);
+      setHasMoreHistory(false);
+      setConversations({});
+      requestedConversationsRef.current.clear();
       setOnlineUsers([]);
       if (socketRef.current) {
         socketRef.current.disconnect();
@@ -213,7 +448,7 @@ export default function Chat() {
   }, [avatarCache]);
   
   useEffect(() => {
-      const allAuthors = Array.from(new Set(messages.map(m => m.pseudo)));
+      const allAuthors = Array.from(new Set(activeMessages.map(m => m.pseudo)));
       console.log("All message authors:", allAuthors);
       console.log("Current uniqueUsers (online users):", uniqueUsers);
       console.log("Current avatarCache:", avatarCache);
@@ -228,7 +463,7 @@ export default function Chat() {
           setAvatarCache(prev => ({ ...prev, [author]: userObj.avatar_url || '/default-avatar.jpg' }));
         }
       });
-    }, [messages, uniqueUsers, avatarCache, fetchAvatar]);
+    }, [activeMessages, uniqueUsers, avatarCache, fetchAvatar]);
 
   const handleReact = (messageId: string, emoji: string) => {
     if (socketRef.current) {
@@ -237,41 +472,12 @@ export default function Chat() {
     setReactingTo(null);
   };
 
-  useEffect(() => {
-    if (!socketRef.current) return;
-
-    const TYPING_TIMEOUT = 3000; // 3 seconds
-
-    const handleTyping = (data: { pseudo: string }) => {
-      setTypingUsers(prev => {
-        const newMap = new Map(prev);
-        newMap.set(data.pseudo, Date.now());
-        return newMap;
-      });
-    };
-
-    socketRef.current.on('typing_users', handleTyping);
-
-    const interval = setInterval(() => {
-      setTypingUsers(prev => {
-        const newMap = new Map(prev);
-        const now = Date.now();
-        for (const [user, timestamp] of prev.entries()) {
-          if (now - timestamp > TYPING_TIMEOUT) {
-            newMap.delete(user);
-          }
-        }
-        return newMap;
-      });
-    }, 1000); // Check every second
-
-    return () => {
-      if (socketRef.current) {
-        socketRef.current.off('typing_users', handleTyping);
-      }
-      clearInterval(interval);
-    };
-  }, [pseudo]);
+  const handleTypingInput = () => {
+    const now = Date.now();
+    if (!socketRef.current || !pseudo || now - lastTypingEmitRef.current < TYPING_EMIT_INTERVAL) return;
+    lastTypingEmitRef.current = now;
+    socketRef.current.emit('user_typing', { pseudo });
+  };
 
 
   function replaceEmojis(text: string) {
@@ -328,7 +534,7 @@ export default function Chat() {
     recipient?: string; // Added recipient to the grouped message type
   }[] = [];
 
-  messages.forEach((msg) => {
+  activeMessages.forEach((msg) => {
     const prev = groupedMessages[groupedMessages.length - 1];
     // Group messages if from the same pseudo AND (both public OR both private between the same two users)
     if (prev && prev.pseudo === msg.pseudo &&
@@ -364,6 +570,9 @@ export default function Chat() {
         handleLogout={handleLogout}
         setSidebarOpen={setSidebarOpen}
         onSelectPrivateChat={setPrivateChatRecipient}
+        rooms={rooms}
+        currentRoom={privateChatRecipient ? null : currentRoom}
+        onSelectRoom={switchRoom}
         sidebarOpen={sidebarOpen}
       />
 
@@ -381,6 +590,7 @@ export default function Chat() {
           handleNavigate={navigate}
           privateChatRecipient={privateChatRecipient}
           setPrivateChatRecipient={setPrivateChatRecipient}
+          currentRoom={currentRoom}
           isAdmin={isAdmin}
         />
 
@@ -398,19 +608,18 @@ export default function Chat() {
           messagesEndRef={messagesEndRef}
           replaceEmojis={replaceEmojis}
           privateChatRecipient={privateChatRecipient}
+          hasMoreHistory={activeHasMore}
+          loadingHistory={loadingHistory}
+          onLoadOlder={loadOlderMessages}
         />
 
-        <TypingIndicator typingUsers={Array.from(typingUsers.keys()) as string[]} /> 
+        <TypingIndicator typingUsers={typingUsers} />
 
         <ChatInputArea
           newMessage={newMessage}
           setNewMessage={setNewMessage}
           sendMessage={sendMessage}
-          onTyping={() => {
-            if (socketRef.current && pseudo) {
-              socketRef.current.emit('user_typing', { pseudo });
-            }
-          }}
+          onTyping={handleTypingInput}
           privateChatRecipient={privateChatRecipient}
         />
       </main>
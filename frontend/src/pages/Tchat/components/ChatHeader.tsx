@@ -6,10 +6,11 @@ interface ChatHeaderProps {
   handleNavigate: (path: string) => void;
   privateChatRecipient: string | null;
   setPrivateChatRecipient: (recipient: string | null) => void;
+  currentRoom: string | null;
   isAdmin: boolean;
 }
 
-function ChatHeader({ setSidebarOpen, handleClearChat, handleNavigate, privateChatRecipient, setPrivateChatRecipient, isAdmin }: ChatHeaderProps) {
+function ChatHeader({ setSidebarOpen, handleClearChat, handleNavigate, privateChatRecipient, setPrivateChatRecipient, currentRoom, isAdmin }: ChatHeaderProps) {
   return (
     <header className="flex items-center justify-between px-4 sm:px-6 py-4 border-b border-[#23272a] bg-[#36393f]">
       <div className="flex items-center gap-3">
@@ -25,7 +26,7 @@ function ChatHeader({ setSidebarOpen, handleClearChat, handleNavigate, privateCh
         </button>
         <span className="text-gray-400 text-xl">#</span>
         <h1 className="text-white text-xl font-bold">
-          {privateChatRecipient ? `Discussion privée avec ${privateChatRecipient}` : "Tchat"}
+          {privateChatRecipient ? `Discussion privée avec ${privateChatRecipient}` : currentRoom ?? "Tchat"}
         </h1>
         {privateChatRecipient && (
           <button
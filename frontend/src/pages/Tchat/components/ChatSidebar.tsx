@@ -13,10 +13,13 @@ interface ChatSidebarProps {
   handleLogout: () => void;
   setSidebarOpen: (open: boolean) => void;
   onSelectPrivateChat: (username: string) => void;
+  rooms: string[];
+  currentRoom: string | null;
+  onSelectRoom: (room: string) => void;
   sidebarOpen: boolean;
 }
 
-function ChatSidebar({ pseudo, uniqueUsers, handleLogout, setSidebarOpen, onSelectPrivateChat, sidebarOpen }: ChatSidebarProps) {
+function ChatSidebar({ pseudo, uniqueUsers, handleLogout, setSidebarOpen, onSelectPrivateChat, rooms, currentRoom, onSelectRoom, sidebarOpen }: ChatSidebarProps) {
   return (
     <aside
       className={`
@@ -43,6 +46,21 @@ function ChatSidebar({ pseudo, uniqueUsers, handleLogout, setSidebarOpen, onSele
           <AvatarUpload
           />
         </div>
+        <div className="px-4 py-4 border-b border-[#23272a]">
+          <h2 className="text-gray-400 text-xs font-bold uppercase mb-2">Salons</h2>
+          <ul className="space-y-1">
+            {rooms.map((room) => (
+              <li key={room}>
+                <button
+                  onClick={() => onSelectRoom(room)}
+                  className={`w-full text-left px-2 py-1 rounded transition ${room === currentRoom ? 'bg-[#40444b] text-white' : 'text-gray-400 hover:bg-[#36393f] hover:text-white'}`}
+                >
+                  <span className="text-gray-500 mr-1">#</span>{room}
+                </button>
+              </li>
+            ))}
+          </ul>
+        </div>
         <div className="px-4 py-4">
           <h2 className="text-gray-400 text-xs font-bold uppercase mb-2">En ligne</h2>
           <ul className="space-y-2">
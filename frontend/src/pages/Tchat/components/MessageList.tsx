@@ -1,5 +1,5 @@
 import ChatMessage from './ChatMessage';
-import React from 'react';
+import React, { useLayoutEffect, useRef } from 'react';
 import '../../../index.css'
 
 
@@ -29,8 +29,13 @@ interface MessageListProps {
   messagesEndRef: React.RefObject<HTMLDivElement | null>;
   replaceEmojis: (text: string) => string;
   privateChatRecipient: string | null; // Add privateChatRecipient
+  hasMoreHistory: boolean;
+  loadingHistory: boolean;
+  onLoadOlder: () => void;
 }
 
+const LOAD_OLDER_THRESHOLD = 80; // px from the top
+
 function MessageList({
   groupedMessages,
   pseudo,
@@ -45,7 +50,32 @@ function MessageList({
   messagesEndRef,
   replaceEmojis,
   privateChatRecipient,
+  hasMoreHistory,
+  loadingHistory,
+  onLoadOlder,
 }: MessageListProps) {
+  const sectionRef = useRef<HTMLElement>(null);
+  const previousHeightRef = useRef<number | null>(null);
+  const firstMessageId = groupedMessages.length > 0 ? groupedMessages[0].id : null;
+
+  // Keep the viewport on the same message when an older page is prepended
+  useLayoutEffect(() => {
+    const section = sectionRef.current;
+    if (section && previousHeightRef.current !== null) {
+      section.scrollTop += section.scrollHeight - previousHeightRef.current;
+      previousHeightRef.current = null;
+    }
+  }, [firstMessageId]);
+
+  const handleScroll = () => {
+    const section = sectionRef.current;
+    if (!section || !hasMoreHistory || loadingHistory) return;
+    if (section.scrollTop < LOAD_OLDER_THRESHOLD) {
+      previousHeightRef.current = section.scrollHeight;
+      onLoadOlder();
+    }
+  };
+
   const filteredMessages = groupedMessages.filter(msg => {
     if (!privateChatRecipient) {
       return !msg.recipient; // Public messages
@@ -58,7 +88,14 @@ function MessageList({
   });
 
   return (
-    <section className="flex-1 overflow-y-auto px-2 sm:px-6 py-2 sm:py-4 space-y-4 sm:space-y-6">
+    <section
+      ref={sectionRef}
+      onScroll={handleScroll}
+      className="flex-1 overflow-y-auto px-2 sm:px-6 py-2 sm:py-4 space-y-4 sm:space-y-6"
+    >
+      {loadingHistory && (
+        <p className="text-gray-400 italic text-center text-sm">Chargement des anciens messages...</p>
+      )}
       {filteredMessages.length === 0 ? (
         <p className="text-gray-400 italic">Aucun message pour le moment</p>
       ) : (